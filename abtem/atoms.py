@@ -2,20 +2,48 @@
 
 from __future__ import annotations
 
+import itertools
+import math
+from functools import lru_cache
 from numbers import Number
 
 import numpy as np
 from ase import Atoms
 from ase.build.tools import cut, rotation_matrix
 from ase.cell import Cell
-from scipy.cluster.hierarchy import fcluster, linkage  # type: ignore
-from scipy.spatial.distance import pdist  # type: ignore
-
-from abtem.core.utils import label_to_index
+from numba import njit  # type: ignore
+from scipy.linalg import solve_triangular  # type: ignore
+from scipy.sparse import csr_matrix  # type: ignore
+from scipy.sparse.csgraph import connected_components  # type: ignore
+from scipy.spatial import cKDTree  # type: ignore
 
 axis_mapping = {"x": (1, 0, 0), "y": (0, 1, 0), "z": (0, 0, 1)}
 
 
+def _constant_array(values) -> np.ndarray:
+    array = np.array(values, dtype=float)
+    array.setflags(write=False)
+    return array
+
+
+_axis_vectors = {key: _constant_array(value) for key, value in axis_mapping.items()}
+
+_off_diagonal = ~np.eye(3, dtype=bool)
+
+_unit_cube_corners = _constant_array(
+    [
+        [0.0, 0.0, 0.0],
+        [0.0, 0.0, 1.0],
+        [0.0, 1.0, 0.0],
+        [0.0, 1.0, 1.0],
+        [1.0, 0.0, 0.0],
+        [1.0, 0.0, 1.0],
+        [1.0, 1.0, 0.0],
+        [1.0, 1.0, 1.0],
+    ]
+)
+
+
 def euler_sequence(axes: str, convention: str) -> tuple[int, int, int, int]:
     """
     Parameters
@@ -117,16 +145,10 @@ def is_cell_hexagonal(atoms: Atoms) -> bool:
     else:
         cell = np.array(atoms)
 
-    a = np.linalg.norm(cell[0], axis=0)
-    b = np.linalg.norm(cell[1], axis=0)
-    c = np.linalg.norm(cell[2], axis=0)
-    angle = np.arccos(np.dot(cell[0], cell[1]) / (a * b))
+    a, b, c = np.linalg.norm(cell, axis=1)
+    cos_angle = abs(np.dot(cell[0], cell[1]) / (a * b))
 
-    return (
-        np.isclose(a, b)
-        & (np.isclose(angle, np.pi / 3) | np.isclose(angle, 2 * np.pi / 3))
-        & (c == cell[2, 2])
-    )
+    return np.isclose(a, b) & np.isclose(cos_angle, 0.5) & (c == cell[2, 2])
 
 
 def is_cell_orthogonal(cell: Atoms | Cell | np.ndarray, tol: float = 1e-12):
@@ -152,7 +174,7 @@ def is_cell_orthogonal(cell: Atoms | Cell | np.ndarray, tol: float = 1e-12):
 
     assert isinstance(cell, np.ndarray)
 
-    return not np.any(np.abs(cell[~np.eye(3, dtype=bool)]) > tol)
+    return not np.any(np.abs(cell[_off_diagonal]) > tol)
 
 
 def is_cell_valid(atoms: Atoms, tol: float = 1e-12) -> bool:
@@ -202,8 +224,10 @@ def standardize_cell(atoms: Atoms, tol: float = 1e-12) -> Atoms:
     atoms : ase.Atoms
         The standardized atoms.
     """
-    atoms = atoms.copy()
+    return _standardize_cell_inplace(atoms.copy(), tol)
 
+
+def _standardize_cell_inplace(atoms: Atoms, tol: float = 1e-12) -> Atoms:
     cell = np.array(atoms.cell)
 
     vertical_vector = np.where(np.all(np.abs(cell[:, :2]) < tol, axis=1))[0]
@@ -236,9 +260,10 @@ def standardize_cell(atoms: Atoms, tol: float = 1e-12) -> Atoms:
     if not np.all(atoms.cell.lengths() == np.abs(np.diag(atoms.cell))):
         raise RuntimeError("Cell has non-orthogonal lattice vectors.")
 
-    atoms.positions[np.diag(cell) < 0.0, :] *= -1
+    diagonal = np.diag(np.array(atoms.cell))
+    atoms.positions[:] *= np.where(diagonal < 0.0, -1.0, 1.0)
 
-    atoms.set_cell(np.diag(np.abs(atoms.get_cell())))
+    atoms.set_cell(np.diag(np.abs(diagonal)))
 
     atoms.pbc = True
     atoms.wrap()
@@ -281,26 +306,28 @@ def rotation_matrix_to_euler(
     j = next_axis[i + parity]
     k = next_axis[i - parity + 1]
 
-    R = np.array(R, dtype=float)
+    # the angles are calculated from scalar matrix elements, hence the math module is
+    # used to avoid the overhead of NumPy functions
+    R = np.array(R, dtype=float).tolist()
     if repetition:
-        sy = np.sqrt(R[i, j] * R[i, j] + R[i, k] * R[i, k])
+        sy = math.sqrt(R[i][j] * R[i][j] + R[i][k] * R[i][k])
         if sy > eps:
-            ax = np.arctan2(R[i, j], R[i, k])
-            ay = np.arctan2(sy, R[i, i])
-            az = np.arctan2(R[j, i], -R[k, i])
+            ax = math.atan2(R[i][j], R[i][k])
+            ay = math.atan2(sy, R[i][i])
+            az = math.atan2(R[j][i], -R[k][i])
         else:
-            ax = np.arctan2(-R[j, k], R[j, j])
-            ay = np.arctan2(sy, R[i, i])
+            ax = math.atan2(-R[j][k], R[j][j])
+            ay = math.atan2(sy, R[i][i])
             az = 0.0
     else:
-        cy = np.sqrt(R[i, i] * R[i, i] + R[j, i] * R[j, i])
+        cy = math.sqrt(R[i][i] * R[i][i] + R[j][i] * R[j][i])
         if cy > eps:
-            ax = np.arctan2(R[k, j], R[k, k])
-            ay = np.arctan2(-R[k, i], cy)
-            az = np.arctan2(R[j, i], R[i, i])
+            ax = math.atan2(R[k][j], R[k][k])
+            ay = math.atan2(-R[k][i], cy)
+            az = math.atan2(R[j][i], R[i][i])
         else:
-            ax = np.arctan2(-R[j, k], R[j, j])
-            ay = np.arctan2(-R[k, i], cy)
+            ax = math.atan2(-R[j][k], R[j][j])
+            ay = math.atan2(-R[k][i], cy)
             az = 0.0
 
     if parity:
@@ -396,17 +423,19 @@ def decompose_affine_transform(
     """
     ZS = np.linalg.cholesky(np.dot(affine_transform.T, affine_transform)).T
 
-    scale = np.diag(ZS)
+    scale = np.diag(ZS).copy()
 
     shear = ZS / scale[:, None]
     shear = shear[np.triu_indices(3, 1)]
 
-    rotation = np.dot(affine_transform, np.linalg.inv(ZS))
+    # ZS is upper triangular, hence rotation = affine_transform @ inv(ZS) is obtained
+    # with a triangular solve
+    rotation = solve_triangular(ZS.T, affine_transform.T, lower=True).T
 
     if np.linalg.det(rotation) < 0:
+        # negating the first row of ZS negates the first column of its inverse
         scale[0] *= -1
-        ZS[0] *= -1
-        rotation = np.dot(affine_transform, np.linalg.inv(ZS))
+        rotation[:, 0] *= -1
 
     return rotation, scale, shear
 
@@ -441,6 +470,10 @@ def merge_close_atoms(atoms: Atoms, tol: float = 1e-7) -> Atoms:
     """
     Merge atoms that are closer in distance to each other than the given tolerance.
 
+    Atoms are merged transitively, i.e. a chain of atoms where each atom is within the
+    tolerance of the next is merged into a single atom at their mean position, even if
+    the ends of the chain are further apart than the tolerance.
+
     Parameters
     ----------
     atoms : ase.Atoms
@@ -464,18 +497,33 @@ def merge_close_atoms(atoms: Atoms, tol: float = 1e-7) -> Atoms:
     k = 0
     for unique in np.unique(atoms.numbers):
         points = atoms.positions[atoms.numbers == unique]
-        clusters = fcluster(
-            linkage(pdist(points), method="complete"), tol, criterion="distance"
+        n = len(points)
+
+        pairs = cKDTree(points).query_pairs(tol, output_type="ndarray")
+
+        if not len(pairs):
+            # no atoms are within the tolerance, hence the clustering is skipped
+            new_points[k : k + n] = points
+            new_numbers[k : k + n] = unique
+            k += n
+            continue
+
+        # the clusters are the connected components of the graph of atom pairs within
+        # the tolerance
+        graph = csr_matrix(
+            (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n, n)
         )
+        num_clusters, labels = connected_components(graph, directed=False)
 
-        i = 0
-        for cluster in label_to_index(clusters):
-            if len(cluster) > 0:
-                new_points[k + i] = np.mean(points[cluster], axis=0)
-                new_numbers[k + i] = unique
-                i += 1
+        counts = np.bincount(labels, minlength=num_clusters)
+        for i in range(3):
+            new_points[k : k + num_clusters, i] = (
+                np.bincount(labels, weights=points[:, i], minlength=num_clusters)
+                / counts
+            )
 
-        k += i
+        new_numbers[k : k + num_clusters] = unique
+        k += num_clusters
 
     new_atoms = Atoms(
         positions=new_points[:k], numbers=new_numbers[:k], cell=atoms.cell
@@ -502,13 +550,14 @@ def wrap_with_tolerance(atoms: Atoms, tol: float = 1e-6) -> Atoms:
     """
     atoms = atoms.copy()
 
-    atoms.wrap()
+    # the tolerance shift below wraps every axis, hence atoms.wrap() is not needed
+    cell = np.array(atoms.cell.complete())
     d = np.linalg.norm(np.array(atoms.cell), axis=0)
     tol = tol / d
-    scaled_positions = atoms.get_scaled_positions()
+    scaled_positions = np.linalg.solve(cell.T, atoms.positions.T).T
     scaled_positions = ((tol + scaled_positions) % 1) - tol
 
-    atoms.positions[:] = atoms.cell.cartesian_positions(scaled_positions)
+    atoms.positions[:] = scaled_positions @ cell
     return atoms
 
 
@@ -580,13 +629,13 @@ def rotation_matrix_from_plane(
         x_vector, y_vector = plane
 
     if isinstance(x_vector, str):
-        x_vector = np.array(axis_mapping[x_vector])
+        x_vector = _axis_vectors[x_vector]
 
     if isinstance(y_vector, str):
-        y_vector = np.array(axis_mapping[y_vector])
+        y_vector = _axis_vectors[y_vector]
 
-    old_x_vector = np.array([1.0, 0.0, 0.0])
-    old_y_vector = np.array([0.0, 1.0, 0.0])
+    old_x_vector = _axis_vectors["x"]
+    old_y_vector = _axis_vectors["y"]
 
     if np.any(x_vector != old_x_vector) or np.any(y_vector != old_y_vector):
         return rotation_matrix(old_x_vector, x_vector, old_y_vector, y_vector)
@@ -638,7 +687,7 @@ def rotate_atoms(
 
     R = euler_to_rotation(*padded_angles, axes=axes, convention=convention)
 
-    atoms.positions[:] = np.dot(atoms.positions, R.T)
+    atoms.positions[:] = atoms.positions @ R.T
     atoms.cell[:] = np.dot(atoms.cell, R.T)
     return atoms
 
@@ -669,10 +718,11 @@ def rotate_atoms_to_plane(
     if isinstance(plane, str):
         axes = plane_to_axes(plane)
 
-    atoms.positions[:] = atoms.positions[:][:, list(axes)]
+    atoms.positions[:] = atoms.positions[:, list(axes)]
     atoms.cell[:] = atoms.cell[:][:, list(axes)]
 
-    atoms = standardize_cell(atoms)
+    # the atoms were already copied above, no need to copy them again
+    atoms = _standardize_cell_inplace(atoms)
 
     return atoms
 
@@ -720,6 +770,21 @@ def best_orthogonal_cell(
     cell : np.ndarray
         Closest orthogonal cell found.
     """
+    if isinstance(max_repetitions, int):
+        max_repetitions = (max_repetitions,) * 3
+
+    # the same cell is typically given many times, e.g. for every frozen phonon
+    # configuration
+    key = tuple(np.array(cell, dtype=float).ravel())
+    return _cached_best_orthogonal_cell(key, tuple(max_repetitions), eps).copy()
+
+
+@lru_cache(maxsize=128)
+def _cached_best_orthogonal_cell(
+    cell_key: tuple[float, ...], max_repetitions: tuple[int, int, int], eps: float
+) -> np.ndarray:
+    cell = np.array(cell_key).reshape((3, 3))
+
     zero_vectors = np.linalg.norm(cell, axis=0) < eps
 
     if zero_vectors.sum() > 1:
@@ -727,48 +792,31 @@ def best_orthogonal_cell(
             "Two or more lattice vectors of the provided `Atoms` object have no length."
         )
 
-    if isinstance(max_repetitions, int):
-        max_repetitions = (max_repetitions,) * 3
-
-    assert isinstance(max_repetitions, tuple)
-
     nx = np.arange(-max_repetitions[0], max_repetitions[0] + 1)
     ny = np.arange(-max_repetitions[1], max_repetitions[1] + 1)
     nz = np.arange(-max_repetitions[2], max_repetitions[2] + 1)
 
-    a, b, c = cell
+    # the lattice vector components are stored along the first axis, hence the
+    # reductions over the repetitions run along contiguous memory
+    a, b, c = np.array(cell)[..., None, None, None]
     vectors = np.abs(
-        (
-            (nx[:, None] * a[None])[:, None, None]
-            + (ny[:, None] * b[None])[None, :, None]
-            + (nz[:, None] * c[None])[None, None, :]
-        )
-    )
+        a * nx[:, None, None] + b * ny[None, :, None] + c * nz[None, None, :]
+    ).reshape((3, -1))
 
-    norm = np.linalg.norm(vectors, axis=-1)
+    norm = np.linalg.norm(vectors, axis=0)
     nonzero = norm > eps
     norm[nonzero == 0] = eps
 
-    new_vectors = []
-    for i in range(3):
-        angles = vectors[..., i] / norm
+    # for each axis, the shortest of the vectors closest to being parallel with it
+    angles = vectors / norm
+    small_angles = (angles.max(axis=1, keepdims=True) - angles < eps) & nonzero
+    shortest_small_angles = np.argmin(np.where(small_angles, norm, np.inf), axis=1)
 
-        small_angles = np.abs(angles.max() - angles < eps)
-
-        small_angles = np.where(small_angles * nonzero)
-
-        shortest_small_angles = np.argmin(np.linalg.norm(vectors[small_angles], axis=1))
-
-        new_vector = np.array(
-            [
-                nx[small_angles[0][shortest_small_angles]],
-                ny[small_angles[1][shortest_small_angles]],
-                nz[small_angles[2][shortest_small_angles]],
-            ]
-        )
-
-        new_vector = np.sign(np.dot(new_vector, cell)[i]) * new_vector
-        new_vectors.append(new_vector)
+    new_vectors = np.array(
+        np.unravel_index(shortest_small_angles, (len(nx), len(ny), len(nz)))
+    ).T
+    new_vectors = new_vectors - np.array(max_repetitions)
+    new_vectors = np.sign(np.diag(np.dot(new_vectors, cell)))[:, None] * new_vectors
 
     cell = np.dot(new_vectors, np.array(cell))
     return np.linalg.norm(cell, axis=0)
@@ -885,6 +933,21 @@ def orthogonalize_cell(
         return atoms
 
 
+@njit(nogil=True, cache=True)
+def _points_in_bounds(
+    points: np.ndarray, lower: np.ndarray, upper: np.ndarray
+) -> np.ndarray:
+    mask = np.empty(points.shape[0], dtype=np.bool_)
+    for i in range(points.shape[0]):
+        inside = True
+        for j in range(points.shape[1]):
+            if not (lower[j] <= points[i, j] < upper[j]):
+                inside = False
+                break
+        mask[i] = inside
+    return mask
+
+
 def atoms_in_cell(
     atoms: Atoms,
     margin: float | tuple[float, float, float] = 0.0,
@@ -910,8 +973,8 @@ def atoms_in_cell(
     scaled_positions = atoms.get_scaled_positions(wrap=False)
     scaled_margins = np.array(margin) / atoms.cell.lengths()
 
-    mask = np.all(scaled_positions >= (-scaled_margins - 1e-12)[None], axis=1) * np.all(
-        scaled_positions < (1 + scaled_margins)[None], axis=1
+    mask = _points_in_bounds(
+        scaled_positions, -scaled_margins - 1e-12, 1 + scaled_margins
     )
 
     atoms = atoms[mask]
@@ -967,31 +1030,52 @@ def cut_cell(
     scaled_margin = atoms.cell.scaled_positions(np.diag(margin))
     scaled_margin = np.sign(scaled_margin) * (np.ceil(np.abs(scaled_margin)))
 
-    scaled_corners_new_cell = np.array(
-        [
-            [0.0, 0.0, 0.0],
-            [0.0, 0.0, 1.0],
-            [0.0, 1.0, 0.0],
-            [0.0, 1.0, 1.0],
-            [1.0, 0.0, 0.0],
-            [1.0, 0.0, 1.0],
-            [1.0, 1.0, 0.0],
-            [1.0, 1.0, 1.0],
-        ]
-    )
-
-    corners = np.dot(scaled_corners_new_cell, new_cell)
+    corners = np.dot(_unit_cube_corners, new_cell)
     scaled_corners = np.linalg.solve(atoms.cell.T, corners.T).T
     repetitions = np.ceil(np.ptp(scaled_corners, axis=0)).astype("int") + 1
-    new_atoms = atoms * repetitions
 
     center_translate = np.dot(np.floor(scaled_corners.min(axis=0)), atoms.cell)
     margin_translate = atoms.cell.cartesian_positions(scaled_margin).sum(0)
+    translate = center_translate - margin_translate
+
+    # only the atoms of the repeated cells that fall within the new cell are replicated,
+    # the positions are given in units of the new orthogonal cell
+    lengths = np.array(cell, dtype=float)
+    scaled_margins = np.array(margin) / lengths
+    lower = -scaled_margins - 1e-12
+    upper = 1 + scaled_margins
+
+    scaled_positions = (atoms.positions + translate) / lengths
+    scaled_shifts = np.array(atoms.cell) / lengths
+
+    min_position = scaled_positions.min(axis=0, initial=np.inf)
+    max_position = scaled_positions.max(axis=0, initial=-np.inf)
+
+    indices = []
+    offsets = []
+    for offset in itertools.product(*(range(n) for n in repetitions)):
+        shift = np.dot(offset, scaled_shifts)
+
+        # skip repeated cells whose atoms all fall outside the new cell
+        if np.any((max_position + shift < lower) | (min_position + shift >= upper)):
+            continue
+
+        mask = _points_in_bounds(scaled_positions, lower - shift, upper - shift)
+        index = np.flatnonzero(mask)
+        indices.append(index)
+        offsets.append(np.tile(offset, (len(index), 1)))
+
+    if indices:
+        index = np.concatenate(indices)
+        offset_positions = np.dot(np.concatenate(offsets), np.array(atoms.cell))
+        offset_positions += translate
+    else:
+        index = np.zeros(0, dtype=int)
+        offset_positions = np.zeros((0, 3))
 
-    new_atoms.positions[:] += center_translate - margin_translate
-
+    new_atoms = atoms[index]
+    new_atoms.positions[:] += offset_positions
     new_atoms.cell = cell
-    new_atoms = atoms_in_cell(new_atoms, margin=margin)
 
     # new_atoms = wrap_with_tolerance(new_atoms)
     return new_atoms
@@ -1030,19 +1114,31 @@ def pad_atoms(
 
     assert isinstance(margins, tuple)
 
-    atoms = atoms.copy()
-    old_cell = atoms.cell.copy()
-
     axes = [{"x": 0, "y": 1, "z": 2}[direction] for direction in directions]
 
     reps = [1, 1, 1]
     for axis, margin in zip(axes, margins):
         reps[axis] = int(1 + 2 * np.ceil(margin / atoms.cell[axis, axis]))
 
-    if any([rep > 1 for rep in reps]):
-        atoms = atoms * reps
-        atoms.positions[:] -= old_cell.sum(axis=0) * [rep // 2 for rep in reps]
-        atoms.cell = old_cell
-
-    atoms = atoms_in_cell(atoms, margins)
-    return atoms
+    # the periodic images are shifted and cropped one at a time, instead of repeating
+    # the full structure and cropping it afterwards, the shifts and the scaling match
+    # repeating the atoms with `atoms * reps` followed by `atoms_in_cell`
+    cell = np.array(atoms.cell)
+    translation = cell.sum(axis=0) * [rep // 2 for rep in reps]
+    scaled_margins = np.array(margins) / atoms.cell.lengths()
+    lower = -scaled_margins - 1e-12
+    upper = 1 + scaled_margins
+
+    indices = []
+    positions = []
+    for offset in itertools.product(*(range(rep) for rep in reps)):
+        shifted_positions = atoms.positions + np.dot(offset, cell)
+        shifted_positions -= translation
+        scaled_positions = atoms.cell.scaled_positions(shifted_positions)
+        index = np.flatnonzero(_points_in_bounds(scaled_positions, lower, upper))
+        indices.append(index)
+        positions.append(shifted_positions[index])
+
+    padded = atoms[np.concatenate(indices)]
+    padded.positions[:] = np.concatenate(positions)
+    return padded
@@ -1,9 +1,11 @@
 from __future__ import annotations
 
 import itertools
+import os
 import warnings
 from abc import ABCMeta, abstractmethod
-from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property, partial
 from numbers import Number
 from typing import Any, Iterable, Optional, Sequence, TypeGuard
 
@@ -11,8 +13,12 @@ import dask.array as da
 import numpy as np
 from ase import Atoms
 from ase.cell import Cell
+from numba import njit, prange, vectorize  # type: ignore
+from scipy.linalg import eigh as eigh_scipy  # type: ignore
 from scipy.linalg import expm as expm_scipy  # type: ignore
+from scipy.sparse.linalg import expm_multiply  # type: ignore
 from scipy.spatial.transform import Rotation  # type: ignore
+from threadpoolctl import threadpool_limits  # type: ignore
 
 from abtem.array import ArrayObject
 from abtem.atoms import is_cell_orthogonal
@@ -21,6 +27,8 @@ from abtem.bloch.utils import (
     excitation_errors,
     filter_reciprocal_space_vectors,
     get_reflection_condition,
+    hkl_difference_lookup_indices,
+    label_overlapping_spots,
     make_hkl_grid,
     reciprocal_cell,
     reciprocal_space_gpts,
@@ -35,7 +43,7 @@ from abtem.core.constants import kappa
 from abtem.core.diagnostics import TqdmWrapper
 from abtem.core.energy import energy2sigma, energy2wavelength
 from abtem.core.ensemble import Ensemble, _wrap_with_array, unpack_blockwise_args
-from abtem.core.fft import fft_interpolate
+from abtem.core.fft import fft_interpolate, irfftn
 from abtem.core.grid import Grid
 from abtem.core.utils import CopyMixin, get_dtype
 from abtem.distributions import BaseDistribution, validate_distribution
@@ -50,6 +58,75 @@ from abtem.potentials.iam import PotentialArray
 
 if cp is not None:
     from abtem.bloch.matrix_exponential import expm as expm_cupy
+    from abtem.core._cuda import structure_factors as structure_factors_cuda
+
+
+@njit(nogil=True, fastmath=True)
+def _fill_scattering_factors(f_e, type_scattering_factors, type_index, occupancy):
+    for i in range(len(type_index)):
+        f = type_scattering_factors[type_index[i]]
+        o = occupancy[i]
+        for j in range(f.shape[0]):
+            f_e[i, j] = f[j] * o
+
+
+@njit(parallel=True, fastmath=True, nogil=True)
+def _sum_structure_phases(f_e, phases_h, phases_k, phases_l, index, out):
+    # the reflections are split into blocks, each block accumulates the sum over
+    # atoms while reading the scattering factors of each atom contiguously
+    block_size = 1024
+    num_blocks = (f_e.shape[1] + block_size - 1) // block_size
+    for block in prange(num_blocks):  # pylint: disable=not-an-iterable
+        start = block * block_size
+        end = min(start + block_size, f_e.shape[1])
+        for i in range(f_e.shape[0]):
+            ph, pk, pl = phases_h[i], phases_k[i], phases_l[i]
+            for j in range(start, end):
+                phase = ph[index[j, 0]] * pk[index[j, 1]] * pl[index[j, 2]]
+                out[j] += f_e[i, j] * phase
+
+
+@vectorize(
+    ["float32(complex64, float32, float32)", "float64(complex128, float64, float64)"]
+)
+def _weighted_abs2(x, sg, sigma):
+    return (x.real**2 + x.imag**2) * np.exp(-(sg**2) / (2.0 * sigma**2))
+
+
+def calculate_cutoff(g: np.ndarray, g_max: float, cutoff: str = "taper") -> np.ndarray:
+    """Calculate the cutoff function applied to the scattering factors.
+
+    Parameters
+    ----------
+    g : np.ndarray
+        The scattering vector lengths [1/Å].
+    g_max : float
+        Maximum scattering vector length [1/Å].
+    cutoff : {'taper', 'hard'}
+        Cutoff function for the scattering factors. 'taper' is a smooth cutoff, 'hard'
+        is a hard cutoff.
+
+    Returns
+    -------
+    np.ndarray
+        The cutoff function evaluated at g.
+    """
+    if cutoff == "taper":
+        T = 0.005
+        alpha = 1 - 0.05
+        x = (g / g_max - alpha) / T
+
+        # the logistic function is saturated to within machine precision outside
+        # |x| < 40, the exponential is only evaluated in the transition region
+        cutoff_array = (x < 0.0).astype(g.dtype)
+        transition = np.abs(x) < 40.0
+        cutoff_array[transition] = 1 / (1 + np.exp(x[transition]))
+    elif cutoff == "hard":
+        cutoff_array = g <= g_max
+    else:
+        raise ValueError("cutoff must be 'taper' or 'hard'")
+
+    return cutoff_array
 
 
 def calculate_scattering_factors(
@@ -60,6 +137,7 @@ def calculate_scattering_factors(
     thermal_sigma: AtomProperties = 0.0,
     occupancy: AtomProperties = 1.0,
     cutoff: str = "taper",
+    device: str = "cpu",
 ):
     """Calculate the scattering factors for a given set of atoms and parametrization.
 
@@ -79,6 +157,9 @@ def calculate_scattering_factors(
     cutoff : {'taper', 'hard'}
         Cutoff function for the scattering factors. 'taper' is a smooth cutoff, 'hard'
         is a hard cutoff.
+    device : {'cpu', 'gpu'}
+        Device of the returned per-atom scattering factors. On the GPU only the
+        scattering factors of each species are transferred.
     """
 
     validated_thermal_sigma, _ = validate_sigmas(
@@ -93,34 +174,44 @@ def calculate_scattering_factors(
 
     parametrization = validate_parametrization(parametrization)
 
-    Z_unique = np.unique(atoms.numbers)
+    cutoff_array = calculate_cutoff(g, g_max, cutoff)
 
-    scattering_factors = {Z: parametrization.scattering_factor(Z) for Z in Z_unique}
+    g2 = g**2
 
-    f_e = np.zeros((len(atoms), len(g)), dtype=get_dtype(complex=True))
+    Z_unique, species_index = np.unique(atoms.numbers, return_inverse=True)
 
-    for i in range(len(atoms)):
-        Z = atoms.numbers[i]
-        s = validated_thermal_sigma[i]
-        o = validated_occupancy[i]
+    scattering_factor = parametrization.get_stacked_function(
+        "scattering_factor", Z_unique
+    )
+    species_scattering_factors = scattering_factor(g2) * cutoff_array
+
+    # atoms of the same species usually share their displacements, hence the
+    # Debye-Waller factors are evaluated once for each unique pair of species and
+    # displacement, the atoms only differ by their occupancy
+    types, type_index = np.unique(
+        np.stack((species_index.ravel(), validated_thermal_sigma)),
+        axis=1,
+        return_inverse=True,
+    )
+    type_species, type_sigma = types[0].astype(int), types[1]
 
-        if s != 0.0:
-            DWF = np.exp(-0.5 * s**2 * g**2 * (2 * np.pi) ** 2)
-        else:
-            DWF = 1.0
+    debye_waller = np.exp(-0.5 * (2 * np.pi * type_sigma[:, None]) ** 2 * g2[None])
+    type_scattering_factors = species_scattering_factors[type_species] * debye_waller
 
-        f_e[i] = scattering_factors[Z](g**2) * DWF * o
+    xp = get_array_module(device)
 
-    if cutoff == "taper":
-        T = 0.005
-        alpha = 1 - 0.05
-        cutoff_array = 1 / (1 + np.exp((g / g_max - alpha) / T))
-    elif cutoff == "hard":
-        cutoff_array = g <= g_max
-    else:
-        raise ValueError("cutoff must be 'taper' or 'hard'")
+    if xp is cp:
+        dtype = get_dtype(complex=False)
+        type_scattering_factors = xp.asarray(type_scattering_factors, dtype=dtype)
+        f_e = type_scattering_factors[xp.asarray(type_index.ravel())]
+        f_e *= xp.asarray(validated_occupancy, dtype=dtype)[:, None]
+        return f_e.astype(get_dtype(complex=True))
 
-    f_e *= cutoff_array
+    f_e = np.empty((len(atoms), len(g)), dtype=get_dtype(complex=True))
+
+    _fill_scattering_factors(
+        f_e, type_scattering_factors, type_index.ravel(), validated_occupancy
+    )
 
     return f_e
 
@@ -178,23 +269,33 @@ def calculate_structure_factors(
         cutoff=cutoff,
         thermal_sigma=thermal_sigma,
         occupancy=occupancy,
+        device=device,
     )
 
     xp = get_array_module(device)
 
     f_e = xp.asarray(f_e, dtype=get_dtype(complex=True))
     positions = xp.asarray(positions, dtype=get_dtype(complex=False))
-    hkl = xp.asarray(hkl.T, get_dtype(complex=False))
 
-    struct_factors = (
-        xp.sum(
-            f_e * xp.exp(2.0j * np.pi * positions @ hkl),
-            axis=0,
-        )
-        / atoms.cell.volume
-    )
+    if xp is cp:
+        hkl = xp.asarray(hkl, dtype=get_dtype(complex=False))
+        return structure_factors_cuda(f_e, positions, hkl) / float(atoms.cell.volume)
 
-    return struct_factors
+    # the phase factor is separable in h, k and l, hence the exponentials are only
+    # evaluated for the unique Miller indices along each axis and the phase of each
+    # reflection is gathered from these tables while summing over the atoms
+    axis_phases = []
+    index = np.empty(hkl.shape, dtype=np.intp)
+    for i in range(3):
+        values, inverse = np.unique(hkl[:, i], return_inverse=True)
+        values = values.astype(get_dtype(complex=False))
+        phases = np.exp(2.0j * np.pi * (positions[:, i, None] % 1.0) * values)
+        axis_phases.append(phases)
+        index[:, i] = inverse.ravel()
+
+    struct_factors = np.zeros(len(hkl), dtype=f_e.dtype)
+    _sum_structure_phases(f_e, *axis_phases, index, struct_factors)
+    return struct_factors / float(atoms.cell.volume)
 
 
 def structure_factor_1d_to_3d(
@@ -218,9 +319,15 @@ def structure_factor_1d_to_3d(
         The 3D structure factors.
     """
     xp = get_array_module(structure_factor)
-    structure_factor_3d = xp.zeros(gpts, dtype=structure_factor.dtype)
-    structure_factor_3d[hkl[:, 0], hkl[:, 1], hkl[:, 2]] = structure_factor
-    return structure_factor_3d
+
+    indices = np.ravel_multi_index(tuple(np.asarray(hkl).T), gpts, mode="wrap")
+
+    if len(indices) == np.prod(gpts) and np.all(indices[1:] > indices[:-1]):
+        return structure_factor.reshape(gpts).copy()
+
+    structure_factor_3d = xp.zeros(np.prod(gpts), dtype=structure_factor.dtype)
+    structure_factor_3d[xp.asarray(indices)] = structure_factor
+    return structure_factor_3d.reshape(gpts)
 
 
 def structure_factor_to_potential(
@@ -244,11 +351,25 @@ def structure_factor_to_potential(
         The potential.
     """
     xp = get_array_module(structure_factor)
-    structure_factor = structure_factor_1d_to_3d(structure_factor, hkl, gpts)
-    potential = xp.fft.ifftn(structure_factor)
-    potential = potential * np.prod(potential.shape) / kappa
+
+    # the potential is the real part of the inverse transform, which is the inverse
+    # transform of the Hermitian part of the structure factors, hence only the half
+    # spectrum with l >= 0 of (F(g) + F*(-g)) / 2 is needed for a real transform
+    half_gpts = gpts[:2] + (gpts[2] // 2 + 1,)
+    hermitian_half = xp.zeros(np.prod(half_gpts), dtype=structure_factor.dtype)
+
+    hkl = np.asarray(hkl)
+    for sign, values in ((1, structure_factor), (-1, xp.conjugate(structure_factor))):
+        index = np.mod(sign * hkl, gpts)
+        in_half = index[:, 2] < half_gpts[2]
+        indices = np.ravel_multi_index(tuple(index[in_half].T), half_gpts)
+        hermitian_half[xp.asarray(indices)] += values[xp.asarray(in_half)] / 2
+
+    potential = irfftn(hermitian_half.reshape(half_gpts), s=gpts, axes=(0, 1, 2))
+
     potential -= potential.min()
-    return potential.real
+    potential *= np.prod(potential.shape) / kappa
+    return potential
 
 
 def equal_slice_thicknesses(
@@ -261,6 +382,21 @@ def equal_slice_thicknesses(
     return slice_thicknesses, n_per_slice
 
 
+@njit(parallel=True, fastmath=True, nogil=True)
+def _sum_slices(
+    potential_3d: np.ndarray,
+    starts: np.ndarray,
+    z_samplings: np.ndarray,
+    out: np.ndarray,
+):
+    for ix in prange(out.shape[1]):  # pylint: disable=not-an-iterable
+        for iy in range(out.shape[2]):
+            column = potential_3d[ix, iy]
+            for s in range(out.shape[0]):
+                acc = column[starts[s] : starts[s + 1]].sum()
+                out[s, ix, iy] = acc * z_samplings[s]
+
+
 def slice_potential(
     potential_3d: np.ndarray,
     slice_chunks: tuple[int, ...],
@@ -279,15 +415,27 @@ def slice_potential(
         thickness / n for n, thickness in zip(slice_chunks, slice_thicknesses)
     )
 
+    xp = get_array_module(potential_3d)
+
     start = np.cumsum((0,) + slice_chunks)
 
-    potential_sliced = np.stack(
-        [
-            np.sum(potential_3d[..., start:stop], axis=-1) * dz
-            for start, stop, dz in zip(start[:-1], start[1:], z_samplings)
-        ],
-        axis=-1,
-    )
+    if xp is np:
+        potential_sliced = np.empty(
+            (num_slices,) + potential_3d.shape[:2], dtype=potential_3d.dtype
+        )
+        _sum_slices(
+            potential_3d,
+            start,
+            np.asarray(z_samplings, dtype=potential_3d.dtype),
+            potential_sliced,
+        )
+        if not rollaxis:
+            potential_sliced = np.moveaxis(potential_sliced, 0, -1)
+
+        return potential_sliced
+
+    potential_sliced = xp.add.reduceat(potential_3d, start[:-1], axis=-1)
+    potential_sliced *= xp.asarray(z_samplings, dtype=potential_sliced.dtype)
 
     if rollaxis:
         potential_sliced = np.rollaxis(potential_sliced, -1)
@@ -316,15 +464,21 @@ class BaseStructureFactor(metaclass=ABCMeta):
         """The unit cell."""
         pass
 
-    @property
+    # the Miller indices and the cell are fixed at initialization, hence the
+    # reciprocal space vectors are calculated once and returned as read-only arrays
+    @cached_property
     def g_vec(self):
         """The reciprocal space vectors."""
-        return self.hkl @ self.cell.reciprocal()
+        g_vec = self.hkl @ self.cell.reciprocal()
+        g_vec.flags.writeable = False
+        return g_vec
 
-    @property
+    @cached_property
     def g_vec_length(self):
         """The lengths of the reciprocal space vectors."""
-        return np.linalg.norm(self.g_vec, axis=1)
+        g_vec_length = np.linalg.norm(self.g_vec, axis=1)
+        g_vec_length.flags.writeable = False
+        return g_vec_length
 
     @property
     @abstractmethod
@@ -394,6 +548,11 @@ class StructureFactor(BaseStructureFactor, CopyMixin):
         if self._centering.lower() != "p":
             hkl = hkl[get_reflection_condition(hkl, self._centering)]
 
+        # the Miller indices are small integers, a narrow integer type reduces the
+        # memory traffic when masking and gathering, differences of indices must fit
+        if np.abs(hkl).max(initial=0) < np.iinfo(np.int16).max // 4:
+            hkl = hkl.astype(np.int16)
+
         self._hkl = hkl
 
         self._g_max = g_max
@@ -446,6 +605,18 @@ class StructureFactor(BaseStructureFactor, CopyMixin):
             cutoff=self._cutoff,
         )
 
+    def _hkl_chunks(self) -> tuple[int, ...]:
+        # the structure factors of each block are calculated from an (atoms, hkl)
+        # array of phases, the Miller indices are chunked such that this temporary
+        # array does not exceed the configured dask chunk size
+        chunks = validate_chunks(
+            (len(self.atoms), len(self.hkl)),
+            (-1, "auto"),
+            dtype=get_dtype(complex=True),
+            device=self._device,
+        )
+        return chunks[1]
+
     def build(self, lazy: bool = True) -> StructureFactorArray:
         """Calculate the structure factors to obtain a StructureFactorArray object.
 
@@ -463,7 +634,7 @@ class StructureFactor(BaseStructureFactor, CopyMixin):
         hkl = self.hkl
         if lazy:
             xp = get_array_module(self._device)
-            array = da.from_array(hkl, chunks=-1).map_blocks(
+            array = da.from_array(hkl, chunks=(self._hkl_chunks(), -1)).map_blocks(
                 calculate_structure_factors,
                 atoms=self.atoms,
                 parametrization=self.parametrization,
@@ -475,6 +646,7 @@ class StructureFactor(BaseStructureFactor, CopyMixin):
                 drop_axis=1,
                 meta=xp.array((), dtype=get_dtype(complex=True)),
             )
+            array = array.rechunk(-1)
         else:
             array = calculate_structure_factors(
                 hkl,
@@ -778,6 +950,28 @@ def calculate_M_matrix(
     return Mii
 
 
+def structure_matrix_indices(hkl: np.ndarray, hkl_selected: np.ndarray) -> np.ndarray:
+    """Calculate the positions of the structure factors coupling each pair of selected
+    reciprocal space vectors, i.e. the positions of g - h in `hkl`.
+
+    Parameters
+    ----------
+    hkl : np.ndarray
+        The reciprocal space vectors as Miller indices corresponding to the structure
+        factors. Given as a (N, 3) array.
+    hkl_selected : np.ndarray
+        The reciprocal space vectors as Miller indices for which the structure matrix is
+        calculated. Given as a (M, 3) array.
+
+    Returns
+    -------
+    np.ndarray
+        The (M, M) array of positions in `hkl`. Missing couplings are given the
+        position `len(hkl)`.
+    """
+    return hkl_difference_lookup_indices(hkl, hkl_selected)
+
+
 def calculate_structure_matrix(
     structure_factor: np.ndarray,
     hkl: np.ndarray,
@@ -786,6 +980,7 @@ def calculate_structure_matrix(
     energy: float,
     gpts: tuple[int, int, int],
     use_wave_eq: bool = False,
+    positions: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """Calculate the structure matrix for a given set of reciprocal space vectors.
 
@@ -808,6 +1003,9 @@ def calculate_structure_matrix(
     use_wave_eq : bool
         If True, the Bloch wave equation derived from the wave equation is used.
         Otherwise standard Bloch wave is used.
+    positions : np.ndarray, optional
+        Precalculated positions of the structure factors coupling each pair of selected
+        reciprocal space vectors, see `structure_matrix_indices`.
 
     Returns
     -------
@@ -819,42 +1017,64 @@ def calculate_structure_matrix(
     g = xp.asarray(calculate_g_vec(hkl_selected, cell))
     Mii = calculate_M_matrix(hkl_selected, cell, energy)
 
-    hkl_selected = np.asarray(hkl_selected)
-
-    gmh = hkl_selected[None] - hkl_selected[:, None]
-    gmh = gmh.reshape(-1, 3)
+    if positions is None:
+        positions = structure_matrix_indices(hkl, hkl_selected)
 
-    A = retrieve_structure_factor_values(structure_factor, hkl, gmh, gpts)
-    A = A.reshape((len(hkl_selected),) * 2)
-
-    # structure_factor_dict = {
-    #     (h, k, l): value for (h, k, l), value in zip(hkl, structure_factor)
-    # }
-    # A = np.array([structure_factor_dict[(h, k, l)] for h, k, l in gmh])
-    # A = A.reshape((len(hkl_selected),) * 2)
+    A = retrieve_structure_factor_values(
+        structure_factor, hkl, hkl_selected, positions=positions
+    )
 
     prefactor = energy2sigma(energy) / (kappa * energy2wavelength(energy) * np.pi)
 
-    Mii = xp.asarray(Mii)
+    Mii = xp.asarray(Mii, dtype=A.real.dtype)
 
-    A *= prefactor * Mii[None] * Mii[:, None]
+    # scaling the rows and columns in place avoids an (N, N) outer product, the
+    # diagonal is overwritten below
+    A *= Mii[None]
+    A *= (prefactor * Mii)[:, None]
 
-    sg = xp.asarray(excitation_errors(g, energy, use_wave_eq=use_wave_eq))
+    sg = excitation_errors(g, energy, use_wave_eq=use_wave_eq)
     diag = 2 * 1 / energy2wavelength(energy) * sg
     diag *= Mii
 
-    xp.fill_diagonal(A, diag)
+    # A is C-contiguous, so the diagonal is a single strided write
+    A.reshape(-1)[:: A.shape[0] + 1] = diag
     return A
 
 
-def calculate_dynamical_scattering(
+def eigh(A: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Calculate the eigendecomposition of a Hermitian matrix.
+
+    This is a device agnostic eigendecomposition using the divide-and-conquer LAPACK
+    driver through scipy on the CPU and cuSOLVER through cupy on the GPU.
+
+    Parameters
+    ----------
+    A : np.ndarray
+        Hermitian input matrix.
+
+    Returns
+    -------
+    np.ndarray
+        The eigenvalues in ascending order.
+    np.ndarray
+        The normalized eigenvectors as columns.
+    """
+    xp = get_array_module(A)
+
+    if xp == cp:
+        return cp.linalg.eigh(A)
+    else:
+        return eigh_scipy(A, driver="evd", check_finite=False)
+
+
+def calculate_bloch_eigenstates(
     structure_matrix: np.ndarray,
     hkl: np.ndarray,
     cell: np.ndarray | Cell,
     energy: float,
-    thicknesses: Sequence[float],
-) -> np.ndarray:
-    """Calculate the dynamical scattering given a structure matrix.
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Calculate the Bloch wave eigenstates given a structure matrix.
 
     Parameters
     ----------
@@ -866,64 +1086,208 @@ def calculate_dynamical_scattering(
         The unit cell.
     energy : float
         The energy of the electrons [eV].
-    thicknesses : sequence of floats
-        The thicknesses of the sample [Å].
 
     Returns
     -------
-    np.ndarray
-        The dynamical scattering as a complex array with shape
-        (len(thicknesses), len(hkl)).
+    gamma : np.ndarray
+        The eigenvalues of the Bloch waves [1/Å].
+    C : np.ndarray
+        The Bloch wave coefficients as a (N, N) array.
+    alpha : np.ndarray
+        The excitation amplitudes of the Bloch waves for an incident plane wave.
     """
-
     xp = get_array_module(structure_matrix)
 
-    Mii = xp.asarray(calculate_M_matrix(hkl, cell, energy))
+    v, U = eigh(structure_matrix)
 
-    v, C = xp.linalg.eigh(structure_matrix)
-    # v, C = scipy.linalg.eigh(structure_matrix)
+    # the M matrix is cast to the precision of the eigenvectors to keep the
+    # coefficients and the propagation in the precision of the structure matrix
+    Mii = xp.asarray(calculate_M_matrix(hkl, cell, energy), dtype=v.dtype)
 
-    gamma = v * energy2wavelength(energy) / 2.0
+    # the wavelength is a numpy double, as a python float it does not promote the
+    # eigenvalues from single precision
+    gamma = v * (float(energy2wavelength(energy)) / 2.0)
 
-    np.fill_diagonal(C, np.diag(C) / Mii)
+    # the eigenvectors U are unitary, hence the excitation amplitudes of an incident
+    # plane wave are the conjugated row of the 000 beam; the Bloch wave coefficients
+    # are C = M @ U with M diagonal
+    (zero_index,) = np.flatnonzero(~np.any(hkl, axis=1))
+    alpha = xp.conjugate(U[zero_index]) / Mii[zero_index]
+    C = U * Mii[:, None]
+    return gamma, C, alpha
 
-    C_inv = xp.conjugate(C.T)
 
-    initial = np.all(hkl == [0, 0, 0], axis=1).astype(complex)
-    initial = xp.asarray(initial)
+def propagate_bloch_eigenstates(
+    gamma: np.ndarray,
+    C: np.ndarray,
+    alpha: np.ndarray,
+    thicknesses: Sequence[float],
+) -> np.ndarray:
+    """Propagate the Bloch wave eigenstates to a given set of thicknesses.
 
-    array = xp.zeros(shape=(len(thicknesses), len(hkl)), dtype=complex)
+    Parameters
+    ----------
+    gamma : np.ndarray
+        The eigenvalues of the Bloch waves [1/Å].
+    C : np.ndarray
+        The Bloch wave coefficients as a (N, N) array.
+    alpha : np.ndarray
+        The excitation amplitudes of the Bloch waves.
+    thicknesses : sequence of floats
+        The thicknesses of the sample [Å].
 
-    for i, thickness in enumerate(thicknesses):
-        alpha = C_inv @ initial
-        array[i] = C @ (xp.exp(2.0j * xp.pi * thickness * gamma) * alpha)
+    Returns
+    -------
+    np.ndarray
+        The dynamical scattering as a complex array with shape
+        (len(thicknesses), N).
+    """
+    xp = get_array_module(C)
 
+    thicknesses = xp.asarray(thicknesses, dtype=gamma.dtype)
+    phases = xp.exp(2.0j * xp.pi * thicknesses[:, None] * gamma[None])
+
+    array = (phases * alpha[None]) @ C.T
     return array
 
 
-# def merge_spots():
-#     g_vec = self.g_vec
-#     clusters = fcluster(
-#         linkage(pdist(g_vec[:, :2]), method="complete"),
-#         merge_tol,
-#         criterion="distance",
-#     )
+def propagate_expm_multiply(
+    structure_matrix: np.ndarray,
+    hkl: np.ndarray,
+    cell: np.ndarray | Cell,
+    energy: float,
+    thicknesses: Sequence[float],
+) -> np.ndarray:
+    """Propagate an incident plane wave through the given thicknesses by applying the
+    action of the matrix exponential of the structure matrix.
 
-#     thicknesses = xp.asarray(thicknesses)
-#     new_array = xp.zeros_like(array, shape=array.shape[:-1] + (clusters.max(),))
-#     new_hkl = np.zeros_like(hkl, shape=(clusters.max(), 3))
-#     for i, cluster in enumerate(label_to_index(clusters, min_label=1)):
+    Parameters
+    ----------
+    structure_matrix : np.ndarray
+        The structure matrix as a (N, N) array.
+    hkl : np.ndarray
+        The reciprocal space vectors as Miller indices. Given as a (N, 3) array.
+    cell : Cell
+        The unit cell.
+    energy : float
+        The energy of the electrons [eV].
+    thicknesses : sequence of floats
+        The thicknesses of the sample [Å].
 
-#         # new_array[:, i] = (array[:, cluster] * xp.exp(-2 * np.pi * 1.0j
-#               * g_vec[i, 2] * thicknesses)[:, None])[:, 0]
-#         new_array[:, i] = array[:, cluster].sum(-1)
+    Returns
+    -------
+    np.ndarray
+        The dynamical scattering as a complex array with shape
+        (len(thicknesses), len(hkl)).
+    """
+    xp = get_array_module(structure_matrix)
 
-#         j = np.argmin(np.abs(excitation_errors(g_vec[cluster], self.energy)))
+    if xp is not np:
+        raise NotImplementedError(
+            "the 'expm_multiply' method is only implemented for the cpu"
+        )
 
-#         new_hkl[i] = hkl[cluster][j]
+    Mii = calculate_M_matrix(hkl, cell, energy)
 
-#     array = new_array
-#     hkl = new_hkl
+    psi = np.all(hkl == [0, 0, 0], axis=1) / Mii
+    psi = psi.astype(structure_matrix.dtype)
+
+    # the matrix is scaled once and shared by all the thicknesses, passing the trace
+    # avoids recalculating it in every call to expm_multiply
+    A = (1.0j * np.pi * float(energy2wavelength(energy))) * structure_matrix
+    trace = np.trace(A)
+
+    thicknesses = np.asarray(thicknesses, dtype=float)
+    unique, inverse = np.unique(thicknesses, return_inverse=True)
+
+    steps = np.diff(unique, prepend=0.0)
+    step = steps[steps > 0.0].min(initial=np.inf)
+    indices = np.round(unique / step).astype(int) if np.isfinite(step) else None
+
+    waves = np.zeros((len(unique), len(hkl)), dtype=structure_matrix.dtype)
+    if indices is None:
+        waves[:] = psi
+    elif np.allclose(indices * step, unique) and indices[-1] <= 2 * len(unique):
+        # thicknesses on an evenly spaced grid are sampled in a single sweep
+        waves[:] = expm_multiply(
+            A,
+            psi,
+            start=0.0,
+            stop=unique[-1],
+            num=indices[-1] + 1,
+            endpoint=True,
+            traceA=trace,
+        )[indices]
+    else:
+        # the wave is propagated in steps between the sorted thicknesses, hence the
+        # cost is set by the largest thickness rather than the sum of the thicknesses
+        z = 0.0
+        for i, thickness in enumerate(unique):
+            if thickness != z:
+                psi = expm_multiply(
+                    A,
+                    psi,
+                    start=0.0,
+                    stop=thickness - z,
+                    num=2,
+                    endpoint=True,
+                    traceA=trace,
+                )[-1]
+            waves[i] = psi
+            z = thickness
+
+    waves *= Mii
+    return waves[inverse.ravel()]
+
+
+def calculate_dynamical_scattering(
+    structure_matrix: np.ndarray,
+    hkl: np.ndarray,
+    cell: np.ndarray | Cell,
+    energy: float,
+    thicknesses: Sequence[float],
+    method: str = "decomposition",
+) -> np.ndarray:
+    """Calculate the dynamical scattering given a structure matrix.
+
+    Parameters
+    ----------
+    structure_matrix : np.ndarray
+        The structure matrix as a (N, N) array.
+    hkl : np.ndarray
+        The reciprocal space vectors as Miller indices. Given as a (N, 3) array.
+    cell : Cell
+        The unit cell.
+    energy : float
+        The energy of the electrons [eV].
+    thicknesses : sequence of floats
+        The thicknesses of the sample [Å].
+    method : {'decomposition', 'expm_multiply'}
+        The method used for propagating the incident wave.
+            ``decomposition`` :
+                Use a Hermitian matrix eigendecomposition. The cost is independent
+                of the thicknesses and the decomposition is shared between them.
+            ``expm_multiply`` :
+                Apply the action of the matrix exponential to the incident wave
+                without forming it, only implemented for the cpu. The cost grows
+                with the largest thickness and a few dense copies of the structure
+                matrix are held in memory while propagating.
+
+    Returns
+    -------
+    np.ndarray
+        The dynamical scattering as a complex array with shape
+        (len(thicknesses), len(hkl)).
+    """
+    if method == "decomposition":
+        gamma, C, alpha = calculate_bloch_eigenstates(
+            structure_matrix, hkl, cell, energy
+        )
+        return propagate_bloch_eigenstates(gamma, C, alpha, thicknesses)
+    elif method == "expm_multiply":
+        return propagate_expm_multiply(structure_matrix, hkl, cell, energy, thicknesses)
+    else:
+        raise ValueError("method must be 'decomposition' or 'expm_multiply'")
 
 
 def expm(A: np.ndarray) -> np.ndarray:
@@ -955,7 +1319,7 @@ def calculate_scattering_matrix(
     cell: np.ndarray | Cell,
     z: float,
     energy: float,
-    method: str = "expm",
+    method: str = "decomposition",
 ) -> np.ndarray:
     """Calculate the scattering matrix for a given set of reciprocal space vectors.
 
@@ -971,12 +1335,12 @@ def calculate_scattering_matrix(
         The thickness of the sample [Å].
     energy : float
         The energy of the electrons [eV].
-    method : {'expm', 'decomposition'}
+    method : {'decomposition', 'expm'}
         The method to use for calculating the scattering matrix.
+            ``decomposition`` :
+                Use a Hermitian matrix eigendecomposition (default).
             ``expm`` :
                 Use a matrix exponential.
-            ``decomposition`` :
-                Use a Hermitian matrix eigendecomposition.
 
     Returns
     -------
@@ -987,14 +1351,18 @@ def calculate_scattering_matrix(
 
     if method == "expm":
         S = expm(1.0j * xp.pi * z * A * energy2wavelength(energy))
+    elif method == "decomposition":
+        v, C = eigh(A)
+        phases = xp.exp(1.0j * xp.pi * z * energy2wavelength(energy) * v)
+        S = (C * phases[None]) @ xp.conjugate(C.T)
     else:
-        raise NotImplementedError("Only 'expm' method is implemented")
+        raise ValueError("method must be 'expm' or 'decomposition'")
 
-    Mii = calculate_M_matrix(hkl, cell, energy)
-    M = xp.asarray(np.diag(Mii))
-    M_inv = xp.asarray(np.diag(1 / Mii))
+    Mii = xp.asarray(calculate_M_matrix(hkl, cell, energy))
 
-    S = xp.dot(M, xp.dot(S, M_inv))
+    # equivalent to M @ S @ M^-1 for the diagonal matrix M
+    S *= Mii[:, None]
+    S /= Mii[None]
     return S
 
 
@@ -1087,13 +1455,21 @@ def exctinction_distances(
 
 #     if max_beams is not None:
 #         mask = np.zeros(len(values), dtype=bool)
-#         mask[np.argsort(values)[:max_beams]] = True
+#         max_beams = min(max_beams, len(values))
+#         mask[np.argpartition(values, max_beams - 1)[:max_beams]] = True
 #     else:
 #         mask = values < np.inf
 
 #     return mask
 
 
+def _sum_sorted_spots(
+    array: np.ndarray, order: np.ndarray, starts: np.ndarray
+) -> np.ndarray:
+    xp = get_array_module(array)
+    return xp.add.reduceat(array[..., order], xp.asarray(starts), axis=-1)
+
+
 class BlochWaves:
     """The BlochWaves class represents a set of Bloch waves. It may be used to calculate
     the dynamical diffraction patterns.
@@ -1119,6 +1495,9 @@ class BlochWaves:
     use_wave_eq : bool
         If True, the Bloch wave equation derived from the wave equation is used.
         Otherwise standard Bloch wave is used.
+    candidates : np.ndarray, optional
+        An optional boolean mask of the reciprocal space vectors of the structure
+        factor. If provided, the Bloch waves are only selected among these vectors.
     """
 
     def __init__(
@@ -1131,6 +1510,7 @@ class BlochWaves:
         centering: str = "P",
         device: Optional[str] = None,
         use_wave_eq: bool = False,
+        candidates: Optional[np.ndarray] = None,
     ):
         cell = structure_factor.cell
 
@@ -1147,9 +1527,15 @@ class BlochWaves:
         self._centering = centering
         self._use_wave_eq = use_wave_eq
         self._device = validate_device(device)
+        self._eigenstates: Optional[tuple[np.ndarray, np.ndarray, np.ndarray]] = None
+        self._structure_matrix_indices: Optional[np.ndarray] = None
 
-        self._hkl_mask = filter_reciprocal_space_vectors(
-            hkl=structure_factor.hkl,
+        hkl = structure_factor.hkl
+        if candidates is not None:
+            hkl = hkl[candidates]
+
+        hkl_mask = filter_reciprocal_space_vectors(
+            hkl=hkl,
             cell=cell,
             energy=energy,
             sg_max=sg_max,
@@ -1157,8 +1543,19 @@ class BlochWaves:
             centering=centering,
         )
 
+        if candidates is not None:
+            candidates_mask = hkl_mask
+            hkl_mask = np.zeros(len(structure_factor.hkl), dtype=bool)
+            hkl_mask[candidates] = candidates_mask
+
+        self._hkl_mask = hkl_mask
+
+        # the selected beams do not change after construction
+        self._hkl = structure_factor.hkl[self._hkl_mask]
+        self._g_vec = self._hkl @ cell.reciprocal()
+
     def __len__(self) -> int:
-        return int(np.sum(self.hkl_mask))
+        return len(self._hkl)
 
     @property
     def hkl_mask(self) -> np.ndarray:
@@ -1166,11 +1563,11 @@ class BlochWaves:
 
     @property
     def hkl(self) -> np.ndarray:
-        return self.structure_factor.hkl[self.hkl_mask]
+        return self._hkl
 
     @property
     def g_vec(self) -> np.ndarray:
-        return self.hkl @ self._cell.reciprocal()
+        return self._g_vec
 
     @property
     def centering(self) -> str:
@@ -1203,7 +1600,7 @@ class BlochWaves:
     @property
     def num_bloch_waves(self) -> int:
         """The number of Bloch waves used."""
-        return int(np.sum(self.hkl_mask))
+        return len(self._hkl)
 
     @property
     def wavelength(self) -> float:
@@ -1239,7 +1636,8 @@ class BlochWaves:
         ----------
         excitation_error_sigma : float
             The standard deviation of the excitation errors used for weigting the
-            structure factor intensities [1/Å].
+            structure factor intensities [1/Å]. If infinite, the intensities are not
+            weighted.
 
         Returns
         -------
@@ -1253,12 +1651,21 @@ class BlochWaves:
         S_array = structure_factor.array[self.hkl_mask]
         sg = self.excitation_errors()
 
-        S_array = abs2(S_array)
-
         if excitation_error_sigma is None:
             excitation_error_sigma = self._sg_max / 3.0
 
-        intensity = S_array * np.exp(-(sg**2) / (2.0 * excitation_error_sigma**2))
+        if np.isinf(excitation_error_sigma):
+            intensity = abs2(S_array)
+        elif isinstance(S_array, np.ndarray):
+            # the intensities and the excitation error weights are evaluated in one pass
+            intensity = _weighted_abs2(
+                S_array, sg.astype(S_array.real.dtype), excitation_error_sigma
+            )
+        else:
+            xp = get_array_module(S_array)
+            sg = xp.asarray(sg)
+            weights = xp.exp(-(sg**2) / (2.0 * excitation_error_sigma**2))
+            intensity = abs2(S_array) * weights
 
         metadata = {"energy": self.energy, "sg_max": self._sg_max, "g_max": self.g_max}
 
@@ -1283,85 +1690,126 @@ class BlochWaves:
         hkl = self.hkl
 
         structure_factor = self._get_structure_factor_array(lazy=lazy)
+        positions = self._get_structure_matrix_indices(structure_factor.hkl)
+
+        # the structure factor may have been built on another device than the one used
+        # for the Bloch waves
+        xp = get_array_module(self._device)
 
         if lazy:
-            xp = get_array_module(self._device)
             A = da.map_blocks(
                 calculate_structure_matrix,
-                structure_factor._lazy_array,
+                structure_factor._lazy_array.map_blocks(xp.asarray),
                 hkl=structure_factor.hkl,
                 hkl_selected=hkl,
                 cell=self.cell,
                 energy=self.energy,
                 use_wave_eq=self.use_wave_eq,
                 gpts=structure_factor.gpts,
+                positions=positions,
                 new_axis=1,
                 chunks=(len(hkl), len(hkl)),
                 meta=xp.array((), dtype=get_dtype(complex=True)),
             )
         else:
             A = calculate_structure_matrix(
-                structure_factor=structure_factor._eager_array,
+                structure_factor=xp.asarray(structure_factor._eager_array),
                 hkl=structure_factor.hkl,
                 hkl_selected=hkl,
                 cell=self.cell,
                 energy=self.energy,
                 use_wave_eq=self.use_wave_eq,
                 gpts=structure_factor.gpts,
+                positions=positions,
             )
         return A
 
-    def calculate_scattering_matrix(self, z: float) -> np.ndarray:
+    def _get_structure_matrix_indices(self, hkl: np.ndarray) -> np.ndarray:
+        # the selected beams do not change after construction, hence the coupling
+        # indices are calculated once and reused, e.g. for a thickness series
+        if self._structure_matrix_indices is None:
+            self._structure_matrix_indices = structure_matrix_indices(hkl, self.hkl)
+        return self._structure_matrix_indices
+
+    def calculate_scattering_matrix(
+        self, z: float, method: str = "decomposition"
+    ) -> np.ndarray:
         """Calculate the scattering matrix for a given thickness.
 
         Parameters
         ----------
         z : float
             The thickness of the sample [Å].
+        method : {'decomposition', 'expm'}
+            The method to use for calculating the scattering matrix.
+                ``decomposition`` :
+                    Use a Hermitian matrix eigendecomposition (default). The
+                    eigendecomposition is reused for every thickness.
+                ``expm`` :
+                    Use a matrix exponential.
 
         Returns
         -------
         np.ndarray
             The scattering matrix.
         """
-        A = self.calculate_structure_matrix()
+        if method == "decomposition":
+            # the eigendecomposition is shared with the diffraction pattern
+            # calculations, with C = M @ U the scattering matrix is
+            # S = M @ U @ diag(phases) @ U^H @ M^-1 = C @ diag(phases) @ C^H @ M^-2
+            gamma, C, _ = self._get_eigenstates()
+            xp = get_array_module(C)
+            Mii = calculate_M_matrix(self.hkl, self.cell, self.energy)
+            Mii = xp.asarray(Mii, dtype=gamma.dtype)
+            phases = xp.exp(2.0j * xp.pi * z * gamma)
+            return (C * phases[None]) @ (xp.conjugate(C.T) / Mii[None] ** 2)
+
+        A = self.calculate_structure_matrix(lazy=False)
         hkl = self.hkl
         cell = self.cell
 
-        xp = get_array_module(self._device)
-        A = xp.asarray(A)
-
         S = calculate_scattering_matrix(
-            A=A, hkl=hkl, cell=cell, z=z, energy=self.energy
+            A=A, hkl=hkl, cell=cell, z=z, energy=self.energy, method=method
         )
         return S
 
-    # def _calculate_array(self, thicknesses: np.ndarray):
-    #     hkl = self.structure_factor.hkl[self.hkl_mask]
-    #     cell = self.cell
-    #     A = self.calculate_structure_matrix(lazy=False)
-
-    #     xp = get_array_module(A)
-
-    #     Mii = xp.asarray(calculate_M_matrix(hkl, cell, self.energy))
-
-    #     v, C = xp.linalg.eigh(A)
-    #     gamma = v * self.wavelength / 2.0
-
-    #     np.fill_diagonal(C, np.diag(C) / Mii)
-
-    #     C_inv = xp.conjugate(C.T)
-
-    #     initial = np.all(hkl == [0, 0, 0], axis=1).astype(complex)
-    #     initial = xp.asarray(initial)
-
-    #     array = xp.zeros(shape=(len(thicknesses), len(hkl)), dtype=complex)
-
-    #     for i, thickness in enumerate(thicknesses):
-    #         alpha = C_inv @ initial
-    #         array[i] = C @ (xp.exp(2.0j * xp.pi * thickness * gamma) * alpha)
+    def _get_eigenstates(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # the eigendecomposition does not depend on the thickness, it is calculated
+        # once and reused by subsequent eager calculations
+        if self._eigenstates is None:
+            A = self.calculate_structure_matrix(lazy=False)
+            self._eigenstates = calculate_bloch_eigenstates(
+                A, hkl=self.hkl, cell=self.cell, energy=self.energy
+            )
+        return self._eigenstates
+
+    def _merge_spots(
+        self, array: np.ndarray, merge_tol: float
+    ) -> tuple[np.ndarray, np.ndarray]:
+        # overlapping spots are summed, the merged spot is indexed by the Miller
+        # indices of the spot closest to the Bragg condition
+        labels = label_overlapping_spots(self.g_vec, merge_tol)
+        sg = np.abs(self.excitation_errors())
+
+        # sorting by label and then excitation error puts the spots of each label
+        # in one contiguous run starting with the representative spot
+        order = np.lexsort((sg, labels))
+        starts = np.flatnonzero(np.diff(labels[order], prepend=-1))
+
+        new_hkl = self.hkl[order[starts]]
+
+        if isinstance(array, da.core.Array):
+            new_array = array.map_blocks(
+                _sum_sorted_spots,
+                order=order,
+                starts=starts,
+                chunks=array.chunks[:-1] + ((len(starts),),),
+                meta=array._meta,
+            )
+        else:
+            new_array = _sum_sorted_spots(array, order, starts)
 
-    #     return array
+        return new_array, new_hkl
 
     def calculate_diffraction_patterns(
         self,
@@ -1369,6 +1817,7 @@ class BlochWaves:
         return_complex: bool = False,
         lazy: bool = True,
         merge_tol: Optional[float] = None,
+        method: str = "decomposition",
     ):
         """Calculate the dynamical diffraction patterns for a given set of thicknesses.
 
@@ -1385,6 +1834,16 @@ class BlochWaves:
         merge_tol : float
             The merge tolerance for merging overlapping diffraction spots.
             Default is None, which means no merging is done.
+        method : {'decomposition', 'expm_multiply'}
+            The method used for propagating the incident wave.
+                ``decomposition`` :
+                    Use a Hermitian matrix eigendecomposition. The eigendecomposition
+                    is reused for subsequent eager calculations.
+                ``expm_multiply`` :
+                    Apply the action of the matrix exponential to the incident wave,
+                    only implemented for the cpu. The cost grows with the largest
+                    thickness and a few dense copies of the structure matrix are held
+                    in memory while propagating.
 
         Returns
         -------
@@ -1401,9 +1860,8 @@ class BlochWaves:
                 ThicknessAxis(label="z", units="Å", values=tuple(thicknesses))
             ]
 
-        A = self.calculate_structure_matrix(lazy=lazy)
-
         if lazy:
+            A = self.calculate_structure_matrix(lazy=True)
             xp = get_array_module(self._device)
             array = da.map_blocks(
                 calculate_dynamical_scattering,
@@ -1412,19 +1870,29 @@ class BlochWaves:
                 cell=self.cell,
                 energy=self.energy,
                 thicknesses=thicknesses,
+                method=method,
                 drop_axis=1,
                 chunks=(len(thicknesses), len(self.hkl)),
                 meta=xp.array((), dtype=get_dtype(complex=True)),
             )
+        elif method == "decomposition":
+            array = propagate_bloch_eigenstates(
+                *self._get_eigenstates(), thicknesses=thicknesses
+            )
         else:
             array = calculate_dynamical_scattering(
-                structure_matrix=A,
+                self.calculate_structure_matrix(lazy=False),
                 hkl=self.hkl,
                 cell=self.cell,
                 energy=self.energy,
                 thicknesses=thicknesses,
+                method=method,
             )
 
+        hkl = self.hkl
+        if merge_tol is not None:
+            array, hkl = self._merge_spots(array, merge_tol)
+
         reciprocal_lattice_vectors = reciprocal_cell(self.cell)
 
         if len(ensemble_axes_metadata) == 0:
@@ -1436,7 +1904,7 @@ class BlochWaves:
             array = abs2(array)
 
         return IndexedDiffractionPatterns(
-            miller_indices=self.hkl,
+            miller_indices=hkl,
             array=array,
             reciprocal_lattice_vectors=reciprocal_lattice_vectors,
             ensemble_axes_metadata=ensemble_axes_metadata,
@@ -1483,10 +1951,6 @@ class BlochWaves:
     #     cell = self.cell
     #     g_vec = self.g_vec
 
-    #     array = self._calculate_array(thicknesses)
-
-    #     xp = get_array_module(array)
-
     # if not is_cell_orthogonal(cell):
     #     #atoms, transform = orthogonalize_cell(Atoms(cell=cell),
     # return_transform=True)
@@ -1496,21 +1960,36 @@ class BlochWaves:
     # supported"
     #     )
 
-    #     array = self._calculate_array(thicknesses)
+    #     array = propagate_bloch_eigenstates(
+    #         *self._get_eigenstates(), thicknesses=thicknesses
+    #     )
 
     #     sampling = (1 / extent[0], 1 / extent[1])
 
     #     nm = _find_projected_pixel_index(self.g_vec, gpts, sampling)
 
+    #     # scattering to the unshifted pixel indices replaces the ifftshift
+    #     nm = (nm - np.array(gpts) // 2) % np.array(gpts)
+
     #     xp = get_array_module(array)
 
     #     thicknesses1 = xp.asarray(thicknesses)
+    #     phase = xp.exp(
+    #         -2 * np.pi * 1.0j * xp.asarray(g_vec[:, 2])[None] * thicknesses1[:, None]
+    #     )
+
+    #     # beams projected to the same pixel are accumulated by a single unbuffered
+    #     # scatter add instead of a loop over the beams
     #     array2 = xp.zeros(array.shape[:-1] + gpts, dtype=array.dtype)
-    #     for i, nmi in enumerate(nm):
-    #         phase = xp.exp(-2 * np.pi * 1.0j * g_vec[i, 2] * thicknesses1)
-    #         array2[..., nmi[0], nmi[1]] += array[..., i] * phase
+    #     flat_index = xp.asarray(np.ravel_multi_index(tuple(nm.T), gpts))
+    #     add_at = cupyx.scatter_add if xp is cp else np.add.at
+    #     add_at(
+    #         array2.reshape(array.shape[:-1] + (-1,)),
+    #         (Ellipsis, flat_index),
+    #         array * phase,
+    #     )
 
-    #     array = ifft2(xp.fft.ifftshift(array2, axes=(-2, -1)))
+    #     array = ifft2(array2, overwrite_x=True)
 
     #     if normalization == "values":
     #         array *= np.prod(gpts)
@@ -1879,7 +2358,6 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         thicknesses: Sequence[float],
         return_complex: bool,
         pbar: bool,
-        merge_tol: float = np.inf,
         hkl_mask: Optional[np.ndarray] = None,
     ):
         if hkl_mask is None:
@@ -1901,11 +2379,19 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         xp = get_array_module(self.device)
         array = xp.zeros(shape, dtype=get_dtype(complex=return_complex))
 
-        # lil_matrix((np.prod(shape[:-1]), shape[-1]))
+        # the structure factors do not depend on the orientation, they are built,
+        # computed and copied to the device once instead of once per orientation
+        structure_factor = self._structure_factor
+        if isinstance(structure_factor, StructureFactor):
+            structure_factor = structure_factor.build(lazy=False)
+        elif structure_factor.is_lazy:
+            structure_factor = structure_factor.compute()
 
-        for i in np.ndindex(orientation_matrices.shape[:-2]):
+        structure_factor = structure_factor.copy_to_device(self.device)
+
+        def calculate_orientation(i: tuple[int, ...]) -> None:
             bw = BlochWaves(
-                structure_factor=self._structure_factor,
+                structure_factor=structure_factor,
                 energy=self.energy,
                 sg_max=self.sg_max,
                 g_max=self.g_max,
@@ -1913,25 +2399,33 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
                 centering=self.centering,
                 device=self.device,
                 use_wave_eq=self._use_wave_eq,
+                candidates=hkl_mask,
             )
 
-            # cols = np.where(bw.hkl_mask)[0]
-            # rows = np.ravel_multi_index(
-            #     i + (tuple(range(shape[-2])),),
-            #     dims=shape[:-1],
-            # )
-
+            # the spots are not merged per orientation, the orientations share the
+            # spots of the ensemble
             diffraction_patterns = bw.calculate_diffraction_patterns(
                 thicknesses,
                 return_complex=return_complex,
-                merge_tol=merge_tol,
                 lazy=False,
             )
 
-            array[..., bw.hkl_mask[hkl_mask]] = diffraction_patterns.array
+            array[i][..., bw.hkl_mask[hkl_mask]] = diffraction_patterns.array
 
             pbar_obj.update_if_exists(1)
 
+        indices = np.ndindex(orientation_matrices.shape[:-2])
+
+        # the orientations are independent and LAPACK releases the GIL, hence they may
+        # be calculated concurrently in threads sharing the structure factor
+        threads = config.get("bloch.threads", 1)
+        if threads > 1:
+            with ThreadPoolExecutor(max_workers=threads) as executor:
+                list(executor.map(calculate_orientation, indices))
+        else:
+            for i in indices:
+                calculate_orientation(i)
+
         pbar_obj.close_if_exists()
 
         return array
@@ -1942,7 +2436,6 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         hkl_mask: np.ndarray,
         thicknesses: Sequence[float],
         return_complex: bool,
-        merge_tol: float,
         pbar: bool,
     ) -> np.ndarray:
         unpacked_block: BlochwaveEnsemble = block.item()
@@ -1950,7 +2443,6 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         array = unpacked_block._calculate_diffraction_intensities(
             thicknesses=thicknesses,
             return_complex=return_complex,
-            merge_tol=merge_tol,
             pbar=pbar,
             hkl_mask=hkl_mask,
         )
@@ -1961,7 +2453,6 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         self,
         thicknesses: Sequence[float],
         return_complex: bool,
-        merge_tol: float,
         pbar: bool,
     ) -> tuple[da.core.Array, np.ndarray]:
         blocks = self.ensemble_blocks(1)
@@ -1982,15 +2473,12 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
             out_ind,
             blocks,
             tuple(range(len(self.ensemble_shape))),
-            da.from_array(hkl_mask),
-            (-1,),
             new_axes={out_ind[-2]: shape[-2], out_ind[-1]: shape[-1]},
+            hkl_mask=hkl_mask,
             thicknesses=thicknesses,
             return_complex=return_complex,
-            merge_tol=merge_tol,
             pbar=pbar,
-            concatenate=True,
-            meta=xp.zeros(shape, dtype=get_dtype(complex=return_complex)),
+            meta=xp.array((), dtype=get_dtype(complex=return_complex)),
         )
         return out, hkl_mask
 
@@ -2000,7 +2488,7 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         return_complex: bool = False,
         lazy: bool = True,
         pbar: Optional[bool] = None,
-        merge_tol: float = 1e-12,
+        merge_tol: Optional[float] = None,
     ) -> IndexedDiffractionPatterns:
         """Calculate the dynamical diffraction patterns of the ensemble for a given set
         of thicknesses.
@@ -2018,6 +2506,10 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         pbar : bool
             If True, a progress bar is shown. Default is None, which means the value is
             taken from the configuration.
+        merge_tol : float, optional
+            Not supported for ensembles, overlapping diffraction spots are not merged.
+            Kept for backwards compatibility, a warning is issued and the value is
+            ignored if given.
 
         Returns
         -------
@@ -2025,6 +2517,12 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
             The diffraction patterns.
         """
 
+        if merge_tol is not None:
+            warnings.warn(
+                "merging overlapping spots is not supported for ensembles of Bloch "
+                "waves, merge_tol is ignored"
+            )
+
         if pbar is None:
             pbar = config.get("local_diagnostics.task_level_progress", False)
 
@@ -2040,24 +2538,33 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
             array, hkl_mask = self._lazy_calculate_diffraction_patterns(
                 thicknesses=thicknesses,
                 return_complex=return_complex,
-                merge_tol=merge_tol,
                 pbar=pbar,
             )
         else:
-            array = self._calculate_diffraction_intensities(
-                thicknesses=thicknesses,
-                return_complex=return_complex,
-                merge_tol=merge_tol,
-                pbar=pbar,
-            )
             hkl_mask = self.get_ensemble_hkl_mask()
 
+            # the BLAS threads are divided between the orientation threads to avoid
+            # oversubscribing the cores, the limits apply to the whole process, hence
+            # they are not set in the lazy calculation where dask tasks run concurrently
+            threads = config.get("bloch.threads", 1)
+            blas_threads = max(1, (os.cpu_count() or 1) // threads)
+            with threadpool_limits(
+                limits=blas_threads if threads > 1 else None, user_api="blas"
+            ):
+                array = self._calculate_diffraction_intensities(
+                    thicknesses=thicknesses,
+                    return_complex=return_complex,
+                    pbar=pbar,
+                    hkl_mask=hkl_mask,
+                )
+
         orientation_matrices = self.get_orientation_matrices()
         hkl = self.structure_factor.hkl[hkl_mask]
 
-        reciprocal_lattice_vectors = np.matmul(
-            self.structure_factor.cell.reciprocal()[None],
-            np.swapaxes(orientation_matrices, -2, -1),
+        reciprocal_lattice_vectors = np.einsum(
+            "ij,...kj->...ik",
+            np.array(self.structure_factor.cell.reciprocal()),
+            orientation_matrices,
         )
 
         if not len(ensemble_axes_metadata):
@@ -2083,4 +2590,3 @@ class BlochwaveEnsemble(Ensemble, CopyMixin):
         )
 
         return result
-        return result
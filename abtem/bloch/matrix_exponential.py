@@ -59,7 +59,7 @@ def expm(a):
 
     # try reducing the norm
     mu = cp.diag(a).sum() / n
-    A = a - cp.eye(n) * mu
+    A = a - cp.eye(n, dtype=a.dtype) * mu
 
     # scale factor
     nrmA = cp.linalg.norm(A, ord=1).item()
@@ -77,9 +77,9 @@ def expm(a):
     A4 = A2 @ A2
     A6 = A2 @ A4
 
-    E = cp.eye(A.shape[0])
+    E = cp.eye(A.shape[0], dtype=A.dtype)
 
-    u1, u2, v1, v2 = _expm_inner(E, A, A2, A4, A6, cp.asarray(b))
+    u1, u2, v1, v2 = _expm_inner(E, A, A2, A4, A6, cp.asarray(b, dtype=A.real.dtype))
     u = A @ (A6 @ u1 + u2)
     v = A6 @ v1 + v2
 
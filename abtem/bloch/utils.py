@@ -4,11 +4,10 @@ import itertools
 from typing import Optional, Sequence
 
 import numpy as np
-import pandas as pd
 from ase.cell import Cell
 from numba import njit  # type: ignore
 
-from abtem.core.backend import cp
+from abtem.core.backend import get_array_module
 from abtem.core.energy import energy2wavelength
 
 
@@ -155,6 +154,15 @@ def make_hkl_grid(
     return hkl
 
 
+@njit(nogil=True, fastmath=True)
+def _excitation_errors(sg, g, wavelength, use_wave_eq):
+    for i in range(len(g)):
+        g2 = g[i, 0] ** 2 + g[i, 1] ** 2
+        if not use_wave_eq:
+            g2 += g[i, 2] ** 2
+        sg[i] = -g[i, 2] - 0.5 * wavelength * g2
+
+
 def excitation_errors(
     g: np.ndarray, energy: float, use_wave_eq: bool = False
 ) -> np.ndarray:
@@ -164,7 +172,8 @@ def excitation_errors(
     Parameters
     ----------
     g : np.ndarray
-        Reciprocal space vectors [1/Å], as an array of shape (N, 3).
+        Reciprocal space vectors [1/Å], as an array of shape (N, 3). The excitation
+        errors are calculated on the device of the given array.
     energy : float
         Electron energy [eV].
     use_wave_eq : bool, optional
@@ -178,13 +187,44 @@ def excitation_errors(
     """
     assert g.shape[-1] == 3
     wavelength = energy2wavelength(energy)
+
+    if isinstance(g, np.ndarray) and g.ndim == 2:
+        dtype = g.dtype if np.issubdtype(g.dtype, np.floating) else np.float64
+        sg = np.empty(len(g), dtype=dtype)
+        _excitation_errors(sg, g, wavelength, use_wave_eq)
+        return sg
+
     if use_wave_eq:
         sg = (-2 * g[..., 2] - wavelength * (g[..., 0] ** 2 + g[..., 1] ** 2)) / 2.0
     else:
-        sg = (-2 * g[..., 2] - wavelength * np.sum(g * g, axis=-1)) / 2.0
+        sg = (-2 * g[..., 2] - wavelength * (g * g).sum(axis=-1)) / 2.0
     return sg
 
 
+def label_overlapping_spots(g: np.ndarray, merge_tol: float) -> np.ndarray:
+    """
+    Label the diffraction spots that overlap in the plane perpendicular to the beam.
+
+    The in-plane components of the reciprocal space vectors are binned on a square
+    grid with a spacing of `merge_tol`, spots in the same bin are given the same label.
+
+    Parameters
+    ----------
+    g : np.ndarray
+        Reciprocal space vectors [1/Å], as an array of shape (N, 3).
+    merge_tol : float
+        The spacing of the grid used for binning the spots [1/Å].
+
+    Returns
+    -------
+    np.ndarray
+        The labels of the spots, consecutive integers starting from zero.
+    """
+    keys = np.round(g[:, :2] / merge_tol).astype(np.int64)
+    _, labels = np.unique(keys, axis=0, return_inverse=True)
+    return labels.ravel()
+
+
 def get_reflection_condition(hkl: np.ndarray, centering: str):
     """
     Returns a boolean mask indicating which reflections satisfy the reflection condition
@@ -305,14 +345,110 @@ def ravel_hkl(hkl: np.ndarray, gpts: tuple[int, int, int]) -> np.ndarray:
     return np.ravel_multi_index(multi_index, gpts)
 
 
+def _hkl_lookup_table(hkl_source: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    hkl_min = hkl_source.min(axis=0)
+    shape = np.ptp(hkl_source, axis=0) + 1
+
+    lookup = np.full(tuple(shape), len(hkl_source), dtype=np.int64)
+    lookup[tuple((hkl_source - hkl_min).T)] = np.arange(len(hkl_source))
+    return lookup, hkl_min
+
+
+def hkl_lookup_indices(
+    hkl_source: np.ndarray, hkl_destination: np.ndarray
+) -> np.ndarray:
+    """
+    Find the positions of a set of destination Miller indices in a source array of
+    Miller indices.
+
+    The positions of the source Miller indices are scattered into a dense 3D lookup
+    table spanning their bounding box, the destination positions are then gathered from
+    this table.
+
+    Parameters
+    ----------
+    hkl_source : np.ndarray
+        The reciprocal space vectors as Miller indices for the source array.
+    hkl_destination : np.ndarray
+        The reciprocal space vectors as Miller indices for the destination array.
+
+    Returns
+    -------
+    np.ndarray
+        The positions in the source array. Destination Miller indices without a
+        corresponding source value are given the position `len(hkl_source)`.
+    """
+    hkl_source = np.asarray(hkl_source)
+    hkl_destination = np.asarray(hkl_destination)
+
+    lookup, hkl_min = _hkl_lookup_table(hkl_source)
+    shape = np.array(lookup.shape)
+
+    index = hkl_destination - hkl_min
+    in_bounds = np.all((index >= 0) & (index < shape), axis=-1)
+    index = np.where(in_bounds[..., None], index, 0)
+
+    positions = lookup[index[..., 0], index[..., 1], index[..., 2]]
+    positions[~in_bounds] = len(hkl_source)
+    return positions
+
+
+def hkl_difference_lookup_indices(
+    hkl_source: np.ndarray, hkl: np.ndarray
+) -> np.ndarray:
+    """
+    Find the positions of the pairwise differences of a set of Miller indices in a
+    source array of Miller indices.
+
+    Equivalent to `hkl_lookup_indices(hkl_source, hkl[None] - hkl[:, None])`, but the
+    differences are accumulated into a flat index of the lookup table one axis at a
+    time, hence the (N, N, 3) array of differences is never created.
+
+    Parameters
+    ----------
+    hkl_source : np.ndarray
+        The reciprocal space vectors as Miller indices for the source array.
+    hkl : np.ndarray
+        The reciprocal space vectors as Miller indices given as a (N, 3) array.
+
+    Returns
+    -------
+    np.ndarray
+        The (N, N) positions in the source array, the element (i, j) is the position of
+        hkl[j] - hkl[i]. Differences without a corresponding source value are given the
+        position `len(hkl_source)`.
+    """
+    hkl_source = np.asarray(hkl_source)
+    hkl = np.asarray(hkl, dtype=np.intp)
+
+    lookup, hkl_min = _hkl_lookup_table(hkl_source)
+
+    flat_index = np.zeros((len(hkl),) * 2, dtype=np.intp)
+    in_bounds = np.ones((len(hkl),) * 2, dtype=bool)
+    for i, n in enumerate(lookup.shape):
+        index = hkl[None, :, i] - hkl[:, None, i] - hkl_min[i]
+        in_bounds &= (index >= 0) & (index < n)
+        flat_index *= n
+        flat_index += index
+
+    flat_index[~in_bounds] = 0
+    positions = lookup.ravel()[flat_index]
+    positions[~in_bounds] = len(hkl_source)
+    return positions
+
+
 def retrieve_structure_factor_values(
     array: np.ndarray,
     hkl_source: np.ndarray,
     hkl_destination: np.ndarray,
-    gpts: tuple[int, int, int],
+    gpts: Optional[tuple[int, int, int]] = None,
+    positions: Optional[np.ndarray] = None,
 ) -> np.ndarray:
     """
-    Convert a raveled array to a 3D array with the shape of the structure factor.
+    Retrieve the structure factor values at a set of destination Miller indices.
+
+    Destination Miller indices without a corresponding source value are given a value
+    of zero.
 
     Parameters
     ----------
@@ -322,32 +458,23 @@ def retrieve_structure_factor_values(
         The reciprocal space vectors as Miller indices for the source array.
     hkl_destination : np.ndarray
         The reciprocal space vectors as Miller indices for the destination array.
-    gpts : tuple of ints
-        The number of grid points in the 3D structure factor.
+    gpts : tuple of ints, optional
+        The number of grid points in the 3D structure factor. Not used, kept for
+        backwards compatibility.
+    positions : np.ndarray, optional
+        Precalculated positions of the destination Miller indices in the source array,
+        see `hkl_lookup_indices`.
 
     Returns
     -------
     np.ndarray
-        The 3D array.
+        The structure factor values at the destination Miller indices.
     """
+    xp = get_array_module(array)
 
-    hkl_source = ravel_hkl(hkl_source, gpts)
-    hkl_destination = ravel_hkl(hkl_destination, gpts)
-
-    if cp is not None and isinstance(array, cp.ndarray):
-        convert_to_numpy = True
-    else:
-        convert_to_numpy = False
-
-    if convert_to_numpy:
-        array = cp.asnumpy(array)
-
-    df = pd.Series(array, index=hkl_source)
-    array = df.loc[hkl_destination].to_numpy()
-
-    # get(hkl_destination, default=0.0).to_numpy()  # type: ignore
-
-    if convert_to_numpy:
-        array = cp.asarray(array)
+    if positions is None:
+        positions = hkl_lookup_indices(hkl_source, hkl_destination)
 
-    return array
+    padded = xp.zeros(len(array) + 1, dtype=array.dtype)
+    padded[:-1] = array
+    return padded[xp.asarray(positions)]
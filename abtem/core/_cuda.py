@@ -154,3 +154,56 @@ def interpolate_bilinear(x, v, u, vw, uw):
     )(x, v, u, vw, uw, H, W, out_H * out_W, y)
 
     return y
+
+
+@cuda.jit
+def _structure_factors(result, scattering_factors, positions, hkl):
+    j = cuda.grid(1)
+
+    if j < result.shape[0]:
+        hkl_h = hkl[j, 0]
+        hkl_k = hkl[j, 1]
+        hkl_l = hkl[j, 2]
+
+        value = 0.0j
+        for i in range(positions.shape[0]):
+            phase = (
+                2.0
+                * math.pi
+                * (
+                    positions[i, 0] * hkl_h
+                    + positions[i, 1] * hkl_k
+                    + positions[i, 2] * hkl_l
+                )
+            )
+            value += scattering_factors[i, j] * (
+                math.cos(phase) + 1.0j * math.sin(phase)
+            )
+
+        result[j] = value
+
+
+def structure_factors(
+    scattering_factors: cp.ndarray, positions: cp.ndarray, hkl: cp.ndarray
+) -> cp.ndarray:
+    """
+    Sum the atomic scattering factors with their structure phases. Each thread reduces
+    over all the atoms for a single reciprocal space vector, avoiding the (atoms, hkl)
+    temporary phase array.
+    """
+    assert scattering_factors.shape == (len(positions), len(hkl))
+
+    result = cp.zeros(len(hkl), dtype=scattering_factors.dtype)
+
+    if len(hkl) == 0:
+        return result
+
+    threadsperblock = (256,)
+    blockspergrid = (int(np.ceil(len(hkl) / threadsperblock[0])),)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=NumbaPerformanceWarning)
+        _structure_factors[blockspergrid, threadsperblock](
+            result, scattering_factors, positions, hkl
+        )
+    return result
@@ -1,10 +1,11 @@
 """Module for handling Fourier transforms and convolution in *ab*TEM."""
 
 import warnings
-from typing import Tuple
+from typing import Optional, Tuple
 
 import dask.array as da
 import numpy as np
+import scipy.fft  # type: ignore
 from threadpoolctl import threadpool_limits  # type: ignore
 
 from abtem.core import config
@@ -241,6 +242,42 @@ def ifftn(x, overwrite_x=False, **kwargs):
     return _fft_dispatch(x, func_name="ifftn", overwrite_x=overwrite_x, **kwargs)
 
 
+def irfftn(
+    x: np.ndarray,
+    s: Optional[tuple[int, ...]] = None,
+    axes: Optional[tuple[int, ...]] = None,
+) -> np.ndarray:
+    """
+    Compute the n-dimensional inverse discrete Fourier Transform of a Hermitian
+    symmetric array, keeping the precision of the input. Using the FFTW library if
+    specified in the configuration.
+    """
+    if isinstance(x, np.ndarray):
+        if config.get("fft") == "fftw":
+            if pyfftw is None:
+                _raise_fft_lib_not_present("pyfftw")
+
+            # the builder plans with the configured effort and reuses the wisdom
+            # accumulated by the other transforms
+            return pyfftw.builders.irfftn(
+                x,
+                s=s,
+                axes=axes,
+                threads=config.get("fftw.threads"),
+                planner_effort=config.get("fftw.planning_effort"),
+            )()
+        elif config.get("fft") in ("mkl", "numpy"):
+            # unlike numpy.fft, the scipy transform preserves single precision
+            return scipy.fft.irfftn(x, s=s, axes=axes)
+        else:
+            raise RuntimeError()
+
+    check_cupy_is_installed()
+
+    if isinstance(x, cp.ndarray):
+        return cp.fft.irfftn(x, s=s, axes=axes)
+
+
 def _fft2_convolve(x, kernel, overwrite_x: bool = False):
     x = fft2(x, overwrite_x=overwrite_x)
     try:
@@ -5,6 +5,7 @@ from __future__ import annotations
 import copy
 import inspect
 import itertools
+import math
 import os
 import warnings
 from typing import Any, Optional, Sequence, TypeVar
@@ -190,11 +191,11 @@ def array_row_intersection(a, b):
 
 
 def safe_floor_int(n: float, tol: int = 7) -> int:
-    return int(np.floor(np.round(n, decimals=tol)))
+    return math.floor(round(float(n), tol))
 
 
 def safe_ceiling_int(n: float, tol: int = 7) -> int:
-    return int(np.ceil(np.round(n, decimals=tol)))
+    return math.ceil(round(float(n), tol))
 
 
 def ensure_list(x):
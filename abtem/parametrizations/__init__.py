@@ -5,11 +5,14 @@ from __future__ import annotations
 import json
 import os
 from abc import ABCMeta, abstractmethod
+from functools import lru_cache
 from numbers import Number
 from typing import Callable, Sequence
 
 import numpy as np
 from ase.data import chemical_symbols
+from numba import njit, prange  # type: ignore
+from numba.core.dispatcher import Dispatcher  # type: ignore
 from scipy.optimize import least_squares
 
 from abtem.array import concatenate
@@ -39,6 +42,28 @@ def validate_sigmas(sigmas: float | dict) -> dict:
     return sigmas
 
 
+_stacked_kernels: dict[Dispatcher, Callable] = {}
+
+
+def _get_stacked_kernel(func: Dispatcher) -> Callable:
+    """
+    Generate (or retrieve a cached) parallel kernel evaluating a jitted parametrized
+    function for several elements. The kernel is specialized for the given function, so
+    the unrolled sum over the terms of the parametrization is inlined in the loop.
+    """
+    if func in _stacked_kernels:
+        return _stacked_kernels[func]
+
+    @njit(parallel=True, fastmath=True, nogil=True)
+    def kernel(r, parameters, out):
+        for i in prange(len(r)):  # pylint: disable=not-an-iterable
+            for j in range(len(parameters)):
+                out[j, i] = func(r[i], parameters[j])
+
+    _stacked_kernels[func] = kernel
+    return kernel
+
+
 class Parametrization(EqualityMixin, metaclass=ABCMeta):
     """
     Base class for potential parametrizations.
@@ -306,6 +331,65 @@ class Parametrization(EqualityMixin, metaclass=ABCMeta):
                 f'parametrized function "{name}" does not exist for element {symbol} with charge {charge}'
             )
 
+    def get_stacked_function(self, name: str, symbols: Sequence[str | int]) -> Callable:
+        """
+        Returns a parameterized function evaluated for several elements at once.
+
+        The parameters of the elements are stacked along a new leading axis, so the
+        returned function is evaluated in a single broadcasted call, rather than once
+        for every element.
+
+        Parameters
+        ----------
+        name : str
+            Name of the function to return.
+        symbols : sequence of str or int
+            Chemical symbols or atomic numbers of the elements.
+
+        Returns
+        -------
+        stacked_function : callable
+            Function returning an array of shape `(len(symbols),) + r.shape`.
+        """
+        symbols = [
+            chemical_symbols[symbol] if not isinstance(symbol, str) else symbol
+            for symbol in symbols
+        ]
+
+        try:
+            func = self._functions[name]
+            parameters = np.stack(
+                [self.scaled_parameters(symbol, name) for symbol in symbols], axis=-1
+            )
+        except KeyError:
+            raise RuntimeError(
+                f'parametrized function "{name}" does not exist for elements {symbols}'
+            )
+
+        parameters = np.array(parameters, dtype=get_dtype(complex=False))
+
+        if isinstance(func, Dispatcher):
+            kernel = _get_stacked_kernel(func)
+            contiguous_parameters = np.ascontiguousarray(np.moveaxis(parameters, -1, 0))
+        else:
+            kernel = None
+
+        def stacked_function(r, *args, **kwargs):
+            r = np.asarray(r)
+
+            if kernel is not None and r.ndim == 1 and not (args or kwargs):
+                out = np.empty(
+                    (len(contiguous_parameters), len(r)),
+                    dtype=np.result_type(r, parameters),
+                )
+                kernel(r, contiguous_parameters, out)
+                return out
+
+            p = parameters.reshape(parameters.shape + (1,) * r.ndim)
+            return func(r[None], p, *args, **kwargs)
+
+        return stacked_function
+
     def line_profiles(
         self,
         symbol: str | Sequence[str],
@@ -662,6 +746,12 @@ def validate_parametrization(parametrization: str | Parametrization) -> Parametr
     return parametrization
 
 
+@lru_cache(maxsize=16)
+def _read_parameters(path: str) -> dict:
+    with open(path, "r") as f:
+        return json.load(f)
+
+
 def validate_parameters(parameters: str | dict) -> dict:
     if isinstance(parameters, str):
         if os.path.isabs(parameters):
@@ -669,8 +759,8 @@ def validate_parameters(parameters: str | dict) -> dict:
         else:
             path = os.path.join(_get_data_path(), parameters)
 
-        with open(path, "r") as f:
-            parameters = json.load(f)
+        # the cached table is shared, a shallow copy keeps fit from modifying it
+        parameters = dict(_read_parameters(path))
 
     elif not isinstance(parameters, dict):
         raise ValueError()
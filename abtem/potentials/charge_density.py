@@ -2,7 +2,7 @@
 
 from __future__ import annotations
 
-from functools import partial
+from functools import lru_cache, partial
 from typing import Tuple, Union
 
 import dask
@@ -10,24 +10,33 @@ import dask.array as da
 import numpy as np
 from ase import Atoms
 from ase.cell import Cell
-from scipy.ndimage import map_coordinates
+from numba import njit, prange
+from scipy.fft import irfftn, rfftn
+from scipy.ndimage import spline_filter
 
 from abtem.atoms import plane_to_axes
 from abtem.core.backend import copy_to_device
 from abtem.core.constants import eps0
 from abtem.core.ensemble import _wrap_with_array
 from abtem.core.fft import fft_crop, fft_interpolate
-from abtem.core.utils import itemset
+from abtem.core.utils import get_dtype, itemset
 from abtem.inelastic.phonons import AtomsEnsemble, DummyFrozenPhonons
 from abtem.parametrizations import EwaldParametrization
 from abtem.potentials.iam import Potential, PotentialArray, _PotentialBuilder
 
 
-def _spatial_frequencies_orthorhombic(shape, cell: Cell):
+def _fftfreq(n, real=False):
+    if real:
+        return np.fft.rfftfreq(n, d=1 / n)
+    return np.fft.fftfreq(n, d=1 / n)
+
+
+def _spatial_frequencies_orthorhombic(shape, cell: Cell, real: bool = False):
     if not cell.orthorhombic:
         raise RuntimeError()
 
-    kx, ky, kz = (np.fft.fftfreq(n, d=1 / n) for n in shape)
+    kx, ky = (np.fft.fftfreq(n, d=1 / n) for n in shape[:2])
+    kz = _fftfreq(shape[2], real)
     lengths = cell.reciprocal().lengths()
     kx = kx[:, None, None] * lengths[0]
     ky = ky[None, :, None] * lengths[1]
@@ -35,28 +44,80 @@ def _spatial_frequencies_orthorhombic(shape, cell: Cell):
     return kx, ky, kz
 
 
-def _spatial_frequencies_meshgrid(shape, cell):
-    kx, ky, kz = (np.fft.fftfreq(n, d=1 / n) for n in shape)
+def _spatial_frequencies_meshgrid(shape, cell, real: bool = False):
+    kx, ky = (np.fft.fftfreq(n, d=1 / n) for n in shape[:2])
+    kz = _fftfreq(shape[2], real)
     kx, ky, kz = np.meshgrid(kx, ky, kz, indexing="ij")
+    new_shape = kx.shape
     kp = np.array([kx.ravel(), ky.ravel(), kz.ravel()]).T
     kx, ky, kz = np.dot(kp, cell.reciprocal().array).T
-    return kx.reshape(shape), ky.reshape(shape), kz.reshape(shape)
+    return kx.reshape(new_shape), ky.reshape(new_shape), kz.reshape(new_shape)
 
 
-def _spatial_frequencies(shape, cell):
+def _spatial_frequencies(shape, cell, real: bool = False):
     if cell.orthorhombic:
-        return _spatial_frequencies_orthorhombic(shape, cell)
+        return _spatial_frequencies_orthorhombic(shape, cell, real)
     else:
-        return _spatial_frequencies_meshgrid(shape, cell)
+        return _spatial_frequencies_meshgrid(shape, cell, real)
+
+
+@lru_cache(maxsize=4)
+def _cached_spatial_frequencies_squared(shape, cell, real):
+    kx, ky, kz = _spatial_frequencies(shape, Cell(cell), real)
+    k2 = kx**2 + ky**2 + kz**2
+    k2.flags.writeable = False
+    return k2
+
+
+def _spatial_frequencies_squared(shape, cell: Cell, real: bool = False):
+    # the frequencies only depend on the grid and the cell, which are shared by every
+    # frozen phonon configuration, hence they are cached as a read-only array
+    cell = tuple(map(tuple, np.array(cell)))
+    return _cached_spatial_frequencies_squared(tuple(shape), cell, real)
+
+
+@lru_cache(maxsize=4)
+def _cached_inverse_cell(cell):
+    inverse_cell = np.linalg.inv(np.array(cell))
+    inverse_cell.flags.writeable = False
+    return inverse_cell
+
+
+def _inverse_cell(cell):
+    # the cell is shared by every frozen phonon configuration and every slice, hence
+    # the inverse is cached like the spatial frequencies
+    return _cached_inverse_cell(tuple(map(tuple, np.array(cell))))
+
+
+def _fft_crop_real(array, shape, new_shape):
+    # crops the half spectrum of a real FFT along the last axis of a real-space array
+    # with the given shape, the first two axes are cropped as a full spectrum, the
+    # input array is returned if the shape is unchanged
+    new_array = array[..., : new_shape[2] // 2 + 1]
+
+    if tuple(new_shape[:2]) != array.shape[:2]:
+        new_array = fft_crop(new_array, tuple(new_shape[:2]) + new_array.shape[2:])
+    elif new_array.shape != array.shape:
+        # only the last axis is cropped, which is a slice of the low frequencies
+        new_array = np.ascontiguousarray(new_array)
+
+    if new_array.shape[2] < new_shape[2] // 2 + 1:
+        padding = ((0, 0), (0, 0), (0, new_shape[2] // 2 + 1 - new_array.shape[2]))
+        new_array = np.pad(new_array, padding)
 
+        if shape[2] % 2 == 0:
+            # the Nyquist frequency of the full spectrum is only padded on one side
+            new_array[..., shape[2] // 2] *= 0.5
 
-def _spatial_frequencies_squared(shape, cell: Cell):
-    kx, ky, kz = _spatial_frequencies(shape, cell)
-    return kx**2 + ky**2 + kz**2
+    return new_array
 
 
 def integrate_gradient_fourier(
-    array: np.ndarray, cell: Cell, in_space: str = "real", out_space: str = "real"
+    array: np.ndarray,
+    cell: Cell,
+    in_space: str = "real",
+    out_space: str = "real",
+    shape: Tuple[int, int, int] = None,
 ) -> np.ndarray:
     """
     Integrate an array representation of a gradient in 3D using Fourier-space integration.
@@ -71,6 +132,9 @@ def integrate_gradient_fourier(
         Space in which the gradient is defined (either "real" or "fourier").
     out_space : str
         Space in which the integrated gradient is defined ("real" or "fourier").
+    shape : three int, optional
+        Shape of the real-space gradient. If given, a Fourier-space array is the half
+        spectrum of a real FFT along the last axis, as given by `scipy.fft.rfftn`.
 
     Returns
     -------
@@ -78,76 +142,76 @@ def integrate_gradient_fourier(
         Integrated gradient.
     """
 
-    if in_space == "real":
+    # the integrated gradient is real, hence the half spectrum of a real FFT is used
+    # unless the full spectrum is requested
+    if in_space == "real" and out_space == "real":
+        shape = array.shape
+        array = rfftn(array, workers=-1)
+    elif in_space == "real":
+        shape = None
         array = np.fft.fftn(array)
+    elif shape is None and out_space == "real":
+        shape = array.shape
+        array = array[..., : shape[2] // 2 + 1]
 
-    k2 = _spatial_frequencies_squared(array.shape, cell)
+    if shape is None:
+        k2 = _spatial_frequencies_squared(array.shape, cell)
+    else:
+        k2 = _spatial_frequencies_squared(shape, cell, real=True)
 
-    k2 = 2**2 * np.pi**2 * k2
+    k2 = np.multiply(2**2 * np.pi**2, k2, dtype=array.real.dtype)
     k2[0, 0, 0] = 1.0
     array /= k2
 
     if out_space == "real":
-        array = np.fft.ifftn(array).real
+        array = irfftn(array, s=shape, workers=-1, overwrite_x=True)
 
     return array
 
 
-def _superpose_deltas(positions, array, scale=1):
-    corners = np.floor(positions).astype(int)
-    shape = array.shape
-
-    xi = np.array([corners[:, 0] % shape[0], (corners[:, 0] + 1) % shape[0]]).T[
-        :, :, None, None
-    ]
-    xi = np.tile(xi, (1, 1, 2, 2)).reshape((len(positions), -1))
-    yi = np.array([corners[:, 1] % shape[1], (corners[:, 1] + 1) % shape[1]]).T[
-        :, None, :, None
-    ]
-    yi = np.tile(yi, (1, 2, 1, 2)).reshape((len(positions), -1))
-    zi = np.array([corners[:, 2] % shape[2], (corners[:, 2] + 1) % shape[2]]).T[
-        :, None, None, :
-    ]
-    zi = np.tile(zi, (1, 2, 2, 1)).reshape((len(positions), -1))
-
-    x, y, z = (positions - corners).T
-    x = np.array([1 - x, x]).T[:, :, None, None]
-    y = np.array([1 - y, y]).T[:, None, :, None]
-    z = np.array([1 - z, z]).T[:, None, None, :]
-
-    values = (x * y * z).reshape((len(positions), -1)) * scale
-    array[xi, yi, zi] += values
+@njit(nogil=True, fastmath=True)
+def _superpose_deltas(positions, array, scales):
+    # the deltas are distributed on the eight surrounding grid points by trilinear
+    # weights, this is a serial loop since neighbouring atoms may share grid points
+    nx, ny, nz = array.shape
+    for i in range(len(positions)):
+        x, y, z = positions[i, 0], positions[i, 1], positions[i, 2]
+        cx, cy, cz = np.floor(x), np.floor(y), np.floor(z)
+        wx, wy, wz = x - cx, y - cy, z - cz
+        cx, cy, cz = int(cx), int(cy), int(cz)
+        for dx in range(2):
+            vx = scales[i] * (wx if dx else 1.0 - wx)
+            ix = (cx + dx) % nx
+            for dy in range(2):
+                vy = vx * (wy if dy else 1.0 - wy)
+                iy = (cy + dy) % ny
+                for dz in range(2):
+                    vz = vy * (wz if dz else 1.0 - wz)
+                    array[ix, iy, (cz + dz) % nz] += vz
     return array
 
 
 def _add_point_charges_real_space(array, atoms):
     pixel_volume = np.prod(np.diag(atoms.cell)) / np.prod(array.shape)
 
-    inverse_cell = np.linalg.inv(np.array(atoms.cell))
+    inverse_cell = _inverse_cell(atoms.cell)
     positions = np.dot(atoms.positions, inverse_cell)
     positions *= array.shape
 
-    for number in np.unique(atoms.numbers):
-        array = _superpose_deltas(
-            positions[atoms.numbers == number],
-            array,
-            scale=number / pixel_volume,
-        )
-
-    return array
-
+    return _superpose_deltas(positions, array, atoms.numbers / pixel_volume)
 
-def _fourier_space_delta(kx, ky, kz, x, y, z):
-    return np.exp(-2 * np.pi * 1j * (kx * x + ky * y + kz * z))
 
-
-def _fourier_space_gaussian(k2, width):
+def _fourier_space_gaussian(k2, width, dtype=np.float64):
     a = np.sqrt(1 / (2 * width**2)) / (2 * np.pi)
-    return np.exp(-1 / (4 * a**2) * k2)
+    gaussian = np.multiply(-1 / (4 * a**2), k2, dtype=dtype)
+    return np.exp(gaussian, out=gaussian)
 
 
 def add_point_charges_fourier(
-    array: np.ndarray, atoms: Atoms, broadening: float = 0.0
+    array: np.ndarray,
+    atoms: Atoms,
+    broadening: float = 0.0,
+    shape: Tuple[int, int, int] = None,
 ) -> np.ndarray:
     """
     Add the nuclear point charges in Reciprocal space.
@@ -160,20 +224,20 @@ def add_point_charges_fourier(
         Atoms from which the nuclear charges with magnitudes and positions are determined.
     broadening : float
         Gaussian broadening of the point charges (default is 0.0).
+    shape : three int, optional
+        Shape of the real-space charge density. If given, the array is the half
+        spectrum of a real FFT along the last axis, as given by `scipy.fft.rfftn`.
 
     Returns
     -------
     density : np.ndarray
         3D charge density with added nuclear charges in reciprocal space.
     """
-    pixel_volume = np.prod(np.diag(atoms.cell)) / np.prod(array.shape)
+    real = shape is not None
+    if not real:
+        shape = array.shape
 
-    kx, ky, kz = _spatial_frequencies(array.shape, atoms.cell)
-
-    if broadening:
-        broadening = _fourier_space_gaussian(kx**2 + ky**2 + kz**2, broadening)
-    else:
-        broadening = 1.0
+    pixel_volume = np.prod(np.diag(atoms.cell)) / np.prod(shape)
 
     if hasattr(atoms, "atoms"):
         atoms = atoms.atoms
@@ -181,40 +245,132 @@ def add_point_charges_fourier(
     if hasattr(atoms, "atoms"):
         atoms = atoms.atoms
 
-    for atom in atoms:
-        scale = atom.number / pixel_volume
-        array += scale * broadening * _fourier_space_delta(kx, ky, kz, *atom.position)
-
-    return array
+    # k.r is the dot product of the integer frequencies and the scaled positions, hence
+    # the phase factors are separable and are evaluated along each axis
+    scaled_positions = np.dot(atoms.positions, _inverse_cell(atoms.cell))
+    phases = [
+        np.exp(
+            -2 * np.pi * 1j * _fftfreq(n, real and i == 2)[:, None] * positions
+        ).astype(array.dtype)
+        for i, (n, positions) in enumerate(zip(shape, scaled_positions.T))
+    ]
+    charges = (atoms.numbers / pixel_volume).astype(array.dtype)
+
+    # the atoms are summed in batches bounding the size of the (x, y, atoms) phases
+    point_charges = np.zeros(array.shape, dtype=array.dtype)
+    batch_size = max(1, 2**22 // (array.shape[0] * array.shape[1]))
+    for start in range(0, len(atoms), batch_size):
+        batch = slice(start, start + batch_size)
+        phases_xy = (phases[0][:, None, batch] * charges[batch]) * phases[1][:, batch]
+        point_charges += (
+            phases_xy.reshape((-1, phases_xy.shape[-1])) @ phases[2][:, batch].T
+        ).reshape(array.shape)
 
+    if broadening:
+        k2 = _spatial_frequencies_squared(shape, atoms.cell, real=real)
+        point_charges *= _fourier_space_gaussian(
+            k2, broadening, dtype=point_charges.real.dtype
+        )
 
-def _interpolate_between_cells(
-    array, new_shape, old_cell, new_cell, offset=(0.0, 0.0, 0.0), order=2
-):
-    x = np.linspace(0, 1, new_shape[0], endpoint=False)
-    y = np.linspace(0, 1, new_shape[1], endpoint=False)
-    z = np.linspace(0, 1, new_shape[2], endpoint=False)
+    array += point_charges
+    return array
 
-    x, y, z = np.meshgrid(x, y, z, indexing="ij")
-    coordinates = np.array([x.ravel(), y.ravel(), z.ravel()]).T
-    coordinates = np.dot(coordinates, new_cell) + offset
 
-    padding = 3
+def _periodic_spline_coefficients(array, padding=3):
     padded_array = np.pad(array, ((padding,) * 2,) * 3, mode="wrap")
+    return spline_filter(padded_array, order=2, mode="wrap")
+
+
+@njit(fastmath=True, nogil=True)
+def _quadratic_spline_weights(x, n, padding):
+    x = (x % 1.0) * n + padding
+    start = np.floor(x + 0.5)
+    t = x - start
+    return (
+        int(start) - 1,
+        0.5 * (0.5 - t) ** 2,
+        0.75 - t**2,
+        0.5 * (0.5 + t) ** 2,
+    )
 
-    inverse_old_cell = np.linalg.inv(np.array(old_cell))
-    mapped_coordinates = np.dot(coordinates, inverse_old_cell) % 1.0
-    mapped_coordinates *= array.shape
-    mapped_coordinates += padding
 
-    interpolated = map_coordinates(
-        padded_array, mapped_coordinates.T, mode="wrap", order=order
+@njit(parallel=True, fastmath=True, nogil=True)
+def _integrate_spline_between_cells(
+    coefficients, shape, new_shape, inverse_old_cell, new_cell, offset, weights
+):
+    # samples the quadratic spline of the padded array like `map_coordinates` and sums
+    # the samples along the last axis of the new cell with the given weights
+    padding = (coefficients.shape[0] - shape[0]) // 2
+    integrated = np.zeros(new_shape[0] * new_shape[1])
+    for p in prange(new_shape[0] * new_shape[1]):  # pylint: disable=not-an-iterable
+        u0 = p // new_shape[1] / new_shape[0]
+        u1 = p % new_shape[1] / new_shape[1]
+        for iz in range(new_shape[2]):
+            u2 = iz / new_shape[2]
+
+            c0 = (
+                offset[0]
+                + u0 * new_cell[0, 0]
+                + u1 * new_cell[1, 0]
+                + u2 * new_cell[2, 0]
+            )
+            c1 = (
+                offset[1]
+                + u0 * new_cell[0, 1]
+                + u1 * new_cell[1, 1]
+                + u2 * new_cell[2, 1]
+            )
+            c2 = (
+                offset[2]
+                + u0 * new_cell[0, 2]
+                + u1 * new_cell[1, 2]
+                + u2 * new_cell[2, 2]
+            )
+
+            x = c0 * inverse_old_cell[0, 0] + c1 * inverse_old_cell[1, 0]
+            x += c2 * inverse_old_cell[2, 0]
+            y = c0 * inverse_old_cell[0, 1] + c1 * inverse_old_cell[1, 1]
+            y += c2 * inverse_old_cell[2, 1]
+            z = c0 * inverse_old_cell[0, 2] + c1 * inverse_old_cell[1, 2]
+            z += c2 * inverse_old_cell[2, 2]
+
+            sx, wx0, wx1, wx2 = _quadratic_spline_weights(x, shape[0], padding)
+            sy, wy0, wy1, wy2 = _quadratic_spline_weights(y, shape[1], padding)
+            sz, wz0, wz1, wz2 = _quadratic_spline_weights(z, shape[2], padding)
+
+            value = 0.0
+            for i in range(3):
+                wx = wx0 if i == 0 else (wx1 if i == 1 else wx2)
+                for j in range(3):
+                    w = wx * (wy0 if j == 0 else (wy1 if j == 1 else wy2))
+                    value += w * (
+                        wz0 * coefficients[sx + i, sy + j, sz]
+                        + wz1 * coefficients[sx + i, sy + j, sz + 1]
+                        + wz2 * coefficients[sx + i, sy + j, sz + 2]
+                    )
+            integrated[p] += weights[iz] * value
+    return integrated.reshape((new_shape[0], new_shape[1]))
+
+
+def _integrate_interpolated_slice(
+    array, cell, slice_shape, slice_box, a, weights, coefficients=None
+):
+    if coefficients is None:
+        coefficients = _periodic_spline_coefficients(array)
+
+    integrated = _integrate_spline_between_cells(
+        coefficients,
+        np.array(array.shape),
+        np.array(slice_shape),
+        _inverse_cell(cell),
+        np.array(slice_box, dtype=np.float64),
+        np.array((0.0, 0.0, a)),
+        weights,
     )
-    interpolated = interpolated.reshape(new_shape)
-    return interpolated
+    return integrated.astype(array.dtype)
 
 
-def _interpolate_slice(array, cell, gpts, sampling, a, b):
+def _interpolate_slice(array, cell, gpts, sampling, a, b, coefficients=None):
     slice_shape = gpts + (int((b - a) / (min(sampling))),)
 
     if slice_shape[-1] <= 1:
@@ -225,13 +381,13 @@ def _interpolate_slice(array, cell, gpts, sampling, a, b):
 
     slice_box = np.diag((gpts[0] * sampling[0], gpts[1] * sampling[1]) + (b - a,))
 
-    slice_array = _interpolate_between_cells(
-        array, slice_shape, cell, slice_box, (0, 0, a)
-    )
-
     dz = (b - a) / slice_shape[-1]
+    weights = np.full(slice_shape[-1], dz)
 
-    return np.sum(slice_array, axis=-1) * dz
+    # the interpolation and the integration are fused to avoid the 3D slice array
+    return _integrate_interpolated_slice(
+        array, cell, slice_shape, slice_box, a, weights, coefficients
+    )
 
 
 def _generate_slices(
@@ -249,22 +405,27 @@ def _generate_slices(
 
     atoms = ewald_potential.frozen_phonons.randomize(atoms)
 
-    charge = -np.fft.fftn(charge)
+    # the charge density is real, hence only the half spectrum is calculated
+    old_shape = charge.shape
+    shape = old_shape[:2] + (ewald_potential.num_slices,)
+    charge = rfftn(charge.astype(get_dtype()), workers=-1, overwrite_x=True)
+    charge = _fft_crop_real(charge, old_shape, shape)
 
-    charge = fft_crop(
-        charge, charge.shape[:2] + (ewald_potential.num_slices,), normalize=True
-    )
+    # the sign of the electron charge and the normalization of the crop are applied
+    # in-place on the cropped spectrum
+    charge *= -np.prod(shape) / np.prod(old_shape)
 
     charge = add_point_charges_fourier(
-        charge, atoms, ewald_potential.integrator.parametrization.width
+        charge, atoms, ewald_potential.integrator.parametrization.width, shape=shape
     )
 
-    potential = (
-        integrate_gradient_fourier(
-            charge, atoms.cell, in_space="fourier", out_space="real"
-        )
-        / eps0
+    potential = integrate_gradient_fourier(
+        charge, atoms.cell, in_space="fourier", out_space="real", shape=shape
     )
+    potential /= eps0
+
+    # the spline coefficients of the potential are shared by all the slices
+    coefficients = _periodic_spline_coefficients(potential)
 
     for i, ((a, b), slic) in enumerate(
         zip(
@@ -273,7 +434,13 @@ def _generate_slices(
         )
     ):
         slice_array = _interpolate_slice(
-            potential, atoms.cell, ewald_potential.gpts, ewald_potential.sampling, a, b
+            potential,
+            atoms.cell,
+            ewald_potential.gpts,
+            ewald_potential.sampling,
+            a,
+            b,
+            coefficients=coefficients,
         )
 
         slic._array = slic._array + copy_to_device(slice_array[None], slic.array)
@@ -414,18 +581,23 @@ class ChargeDensityPotential(_PotentialBuilder):
         else:
             blocks = np.zeros((len(chunks[0]),), dtype=object)
 
+        num_configurations = int(np.prod(self.ensemble_shape))
+        if charge_densities.shape[0] not in (1, num_configurations):
+            raise ValueError(
+                f"The number of charge densities ({charge_densities.shape[0]}) must "
+                f"be one or equal to the number of frozen phonon configurations "
+                f"({num_configurations})."
+            )
+
+        shared = charge_densities.shape[0] == 1
+
         if lazy:
             if not isinstance(charge_densities, da.core.Array):
                 charge_densities = da.from_array(
                     charge_densities, chunks=(1, -1, -1, -1)
                 )
 
-            if charge_densities.shape[0] != self.ensemble_shape:
-                charge_densities = da.tile(
-                    charge_densities, self.ensemble_shape + (1, 1, 1)
-                )
-
-            charge_densities = charge_densities.to_delayed()
+            charge_densities = charge_densities.to_delayed().ravel()
 
         elif hasattr(charge_densities, "compute"):
             raise RuntimeError
@@ -434,12 +606,17 @@ class ChargeDensityPotential(_PotentialBuilder):
             lazy=lazy
         )[0]
 
+        if shared:
+            # a single charge density is shared by all the frozen phonon configurations,
+            # hence the same (delayed) array is referenced instead of being tiled
+            charge_densities = [charge_densities[0]] * len(frozen_phonon_blocks)
+
         for i, (charge_density, frozen_phonon) in enumerate(
             zip(charge_densities, frozen_phonon_blocks)
         ):
             if lazy:
                 block = dask.delayed(self._wrap_charge_density)(
-                    charge_density.item(), frozen_phonon
+                    charge_density, frozen_phonon
                 )
                 itemset(blocks, i, da.from_delayed(block, shape=(1,), dtype=object))
 
@@ -489,13 +666,14 @@ class ChargeDensityPotential(_PotentialBuilder):
 
         slice_box = np.diag(self.box[:2] + (b - a,))
 
-        slice_array = _interpolate_between_cells(
-            array, slice_shape, cell, slice_box, (0, 0, a)
-        )
-
         pixel_thickness = slice_shape[-1] - 1
 
-        return np.trapz(slice_array, axis=-1, dx=(b - a) / pixel_thickness)
+        weights = np.full(slice_shape[-1], (b - a) / pixel_thickness)
+        weights[[0, -1]] /= 2
+
+        return _integrate_interpolated_slice(
+            array, cell, slice_shape, slice_box, a, weights
+        )
 
     def _integrate_slice(self, array, a, b):
         dz = self.box[2] / array.shape[2]
@@ -32,7 +32,11 @@ from abtem.inelastic.phonons import (
     _safe_read_atoms,
 )
 from abtem.parametrizations import EwaldParametrization, LobatoParametrization
-from abtem.potentials.charge_density import _generate_slices, _interpolate_slice
+from abtem.potentials.charge_density import (
+    _generate_slices,
+    _interpolate_slice,
+    _periodic_spline_coefficients,
+)
 from abtem.potentials.iam import Potential, PotentialArray, _PotentialBuilder
 
 try:
@@ -246,6 +250,7 @@ def _generate_slices(
         transform_valence_potential = False
     else:
         transform_valence_potential = True
+        coefficients = _periodic_spline_coefficients(valence_potential)
 
     if last_slice is None:
         last_slice = len(potential)
@@ -260,7 +265,13 @@ def _generate_slices(
 
         if transform_valence_potential:
             slic.array[:] -= _interpolate_slice(
-                valence_potential, atoms.cell, potential.gpts, potential.sampling, a, b
+                valence_potential,
+                atoms.cell,
+                potential.gpts,
+                potential.sampling,
+                a,
+                b,
+                coefficients=coefficients,
             )
         else:
             slic.array[:] -= integrate_slice(
@@ -5,7 +5,7 @@ from __future__ import annotations
 import itertools
 from abc import abstractmethod
 from copy import copy
-from functools import partial
+from functools import lru_cache, partial
 from numbers import Number
 from typing import TYPE_CHECKING, Optional, Sequence
 
@@ -108,13 +108,32 @@ def _ensure_parity_of_gpts(new_gpts, old_gpts, parity):
         raise ValueError()
 
 
-def _antialias_cutoff_gpts(gpts, sampling):
+@lru_cache(maxsize=32)
+def _cached_antialias_cutoff_gpts(gpts, sampling):
     kcut = 2.0 / 3.0 / max(sampling)
     extent = gpts[0] * sampling[0], gpts[1] * sampling[1]
     new_gpts = safe_floor_int(kcut * extent[0]), safe_floor_int(kcut * extent[1])
     return _ensure_parity_of_gpts(new_gpts, gpts, parity="same")
 
 
+@lru_cache(maxsize=32)
+def _cached_antialias_valid_gpts(cutoff_gpts, gpts):
+    valid_gpts = (
+        safe_floor_int(cutoff_gpts[0] / np.sqrt(2)),
+        safe_floor_int(cutoff_gpts[1] / np.sqrt(2)),
+    )
+    return _ensure_parity_of_gpts(valid_gpts, gpts, parity="same")
+
+
+def _antialias_cutoff_gpts(gpts, sampling):
+    # the cutoff is queried repeatedly during multislice, but only depends on the grid
+    return _cached_antialias_cutoff_gpts(tuple(gpts), tuple(sampling))
+
+
+def _antialias_valid_gpts(cutoff_gpts, gpts):
+    return _cached_antialias_valid_gpts(tuple(cutoff_gpts), tuple(gpts))
+
+
 class BaseWaves(HasGrid2DMixin, HasAcceleratorMixin):
     """Base class of all wave functions. Documented in the subclasses."""
 
@@ -189,13 +208,7 @@ class BaseWaves(HasGrid2DMixin, HasAcceleratorMixin):
         The number of grid points along the x and y direction in the simulation grid for the largest rectangle that fits
         within antialiasing cutoff scattering angle.
         """
-        cutoff_gpts = self.antialias_cutoff_gpts
-        valid_gpts = (
-            safe_floor_int(cutoff_gpts[0] / np.sqrt(2)),
-            safe_floor_int(cutoff_gpts[1] / np.sqrt(2)),
-        )
-
-        valid_gpts = _ensure_parity_of_gpts(valid_gpts, self.gpts, parity="same")
+        valid_gpts = _antialias_valid_gpts(self.antialias_cutoff_gpts, self.gpts)
 
         if "adjusted_antialias_cutoff_gpts" in self.metadata:
             n = min(self.metadata["adjusted_antialias_cutoff_gpts"][0], valid_gpts[0])
@@ -232,18 +245,22 @@ class BaseWaves(HasGrid2DMixin, HasAcceleratorMixin):
     @property
     def cutoff_angles(self) -> tuple[float, float]:
         """Scattering angles at the antialias cutoff [mrad]."""
+        gpts = self.antialias_cutoff_gpts
+        angular_sampling = self.angular_sampling
         return (
-            self.antialias_cutoff_gpts[0] // 2 * self.angular_sampling[0],
-            self.antialias_cutoff_gpts[1] // 2 * self.angular_sampling[1],
+            gpts[0] // 2 * angular_sampling[0],
+            gpts[1] // 2 * angular_sampling[1],
         )
 
     @property
     def rectangle_cutoff_angles(self) -> tuple[float, float]:
         """Scattering angles corresponding to the sides of the largest rectangle within
         the antialias cutoff [mrad]."""
+        gpts = self.antialias_valid_gpts
+        angular_sampling = self.angular_sampling
         return (
-            self.antialias_valid_gpts[0] // 2 * self.angular_sampling[0],
-            self.antialias_valid_gpts[1] // 2 * self.angular_sampling[1],
+            gpts[0] // 2 * angular_sampling[0],
+            gpts[1] // 2 * angular_sampling[1],
         )
 
     @property
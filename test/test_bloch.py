@@ -0,0 +1,144 @@
+import numpy as np
+import pytest
+from ase.build import bulk
+
+from abtem import config
+from abtem.bloch import BlochWaves, StructureFactor
+from abtem.bloch.dynamical import (
+    BlochwaveEnsemble,
+    calculate_bloch_eigenstates,
+    calculate_scattering_matrix,
+    propagate_bloch_eigenstates,
+    propagate_expm_multiply,
+)
+from abtem.bloch.utils import label_overlapping_spots
+
+
+def silicon_bloch_waves(sg_max=0.1):
+    atoms = bulk("Si", cubic=True)
+    structure_factor = StructureFactor(atoms, g_max=4.0)
+    return BlochWaves(structure_factor, energy=100e3, sg_max=sg_max)
+
+
+def test_label_overlapping_spots():
+    g = np.array(
+        [
+            [0.0, 0.0, 0.0],
+            [0.0, 0.0, 1.0],
+            [1.0, 0.0, 0.0],
+            [1.0 + 1e-9, 0.0, 0.5],
+            [0.0, 2.0, 0.0],
+        ]
+    )
+
+    labels = label_overlapping_spots(g, merge_tol=1e-6)
+
+    assert labels[0] == labels[1]
+    assert labels[2] == labels[3]
+    assert len(np.unique(labels)) == 3
+
+
+def test_merge_spots():
+    # the excitation error cutoff includes spots overlapping in projection
+    bw = silicon_bloch_waves(sg_max=0.2)
+    merge_tol = 1e-6
+
+    rng = np.random.default_rng(seed=0)
+    array = rng.random((2, len(bw))) + 1.0j * rng.random((2, len(bw)))
+
+    merged, merged_hkl = bw._merge_spots(array, merge_tol)
+
+    labels = label_overlapping_spots(bw.g_vec, merge_tol)
+    sg = np.abs(bw.excitation_errors())
+
+    assert len(merged_hkl) == len(np.unique(labels)) < len(bw)
+
+    for label in np.unique(labels):
+        (members,) = np.nonzero(labels == label)
+        representative = members[np.argmin(sg[members])]
+
+        assert np.all(merged_hkl[label] == bw.hkl[representative])
+        assert np.allclose(merged[:, label], array[:, members].sum(-1))
+
+
+def test_bloch_eigenstates_match_scattering_matrix():
+    bw = silicon_bloch_waves()
+    thicknesses = [10.0, 50.0, 100.0]
+
+    A = bw.calculate_structure_matrix(lazy=False)
+    (zero_index,) = np.flatnonzero(~np.any(bw.hkl, axis=1))
+
+    gamma, C, alpha = calculate_bloch_eigenstates(A, bw.hkl, bw.cell, bw.energy)
+    array = propagate_bloch_eigenstates(gamma, C, alpha, thicknesses)
+
+    for i, z in enumerate(thicknesses):
+        S = calculate_scattering_matrix(
+            A.copy(), bw.hkl, bw.cell, z, bw.energy, method="expm"
+        )
+        assert np.allclose(array[i], S[:, zero_index], atol=1e-4)
+
+    expm_multiply_array = propagate_expm_multiply(
+        A, bw.hkl, bw.cell, bw.energy, thicknesses
+    )
+    assert np.allclose(array, expm_multiply_array, atol=1e-4)
+
+
+@pytest.fixture
+def silicon_bloch_wave_ensemble():
+    atoms = bulk("Si", cubic=True)
+    structure_factor = StructureFactor(atoms, g_max=4.0)
+    return BlochwaveEnsemble(
+        "x",
+        np.array([0.0, 0.05]),
+        structure_factor=structure_factor,
+        energy=100e3,
+        sg_max=0.1,
+        g_max=2.0,
+    )
+
+
+def test_ensemble_diffraction_patterns(silicon_bloch_wave_ensemble):
+    ensemble = silicon_bloch_wave_ensemble
+    thicknesses = [10.0, 50.0]
+
+    eager = ensemble.calculate_diffraction_patterns(thicknesses, lazy=False)
+    lazy = ensemble.calculate_diffraction_patterns(thicknesses, lazy=True).compute()
+
+    with config.set({"bloch.threads": 2}):
+        threaded = ensemble.calculate_diffraction_patterns(thicknesses, lazy=False)
+
+    with config.set({"bloch.threads": 1}):
+        serial = ensemble.calculate_diffraction_patterns(thicknesses, lazy=False)
+
+    # each orientation is written to its own part of the array
+    assert not np.allclose(eager.array[0], eager.array[1])
+
+    assert np.allclose(eager.array, lazy.array)
+    assert np.allclose(serial.array, threaded.array)
+
+
+def test_diffraction_intensities_match_double_precision():
+    atoms = bulk("Si", cubic=True)
+    thicknesses = [10.0, 50.0, 100.0]
+
+    def calculate_intensities():
+        structure_factor = StructureFactor(atoms, g_max=4.0)
+        bw = BlochWaves(structure_factor, energy=100e3, sg_max=0.1)
+        patterns = bw.calculate_diffraction_patterns(thicknesses, lazy=False)
+        return patterns.array
+
+    intensities = calculate_intensities()
+
+    with config.set({"precision": "float64"}):
+        double_intensities = calculate_intensities()
+
+    assert intensities.dtype == np.float32
+    assert double_intensities.dtype == np.float64
+    assert np.allclose(intensities, double_intensities, atol=1e-4)
+
+
+def test_ensemble_merge_tol_warns(silicon_bloch_wave_ensemble):
+    with pytest.warns(UserWarning, match="merge_tol is ignored"):
+        silicon_bloch_wave_ensemble.calculate_diffraction_patterns(
+            10.0, lazy=True, merge_tol=1e-3
+        )
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from abtem import config
+from abtem.core.fft import irfftn
+
+
+@pytest.mark.parametrize("fft", ["fftw", "numpy"])
+def test_irfftn_preserves_precision(fft):
+    rng = np.random.default_rng(seed=0)
+    array = rng.standard_normal((8, 6, 10)).astype(np.float32)
+    half_spectrum = np.fft.rfftn(array).astype(np.complex64)
+
+    with config.set({"fft": fft}):
+        transformed = irfftn(half_spectrum, s=array.shape, axes=(0, 1, 2))
+
+    assert transformed.dtype == np.float32
+    assert np.allclose(transformed, array, atol=1e-5)
@@ -45,3 +45,15 @@ def test_lobato_kirkland_match(atomic_number, func):
 #     f1 = getattr(gpaw, func)(chemical_symbols[atomic_number])(r)
 #     f2 = getattr(lobato, func)(chemical_symbols[atomic_number])(r)
 #     assert array_is_close(f1, f2, rel_tol=0.05, check_above_rel=.02)
+
+
+@pytest.mark.parametrize("parametrization", [LobatoParametrization(),
+                                             KirklandParametrization()])
+@pytest.mark.parametrize("func", ['potential', 'scattering_factor'])
+def test_stacked_function_matches(parametrization, func):
+    r = np.linspace(0.01, 4., 10)
+    symbols = ["H", "Si", "Au"]
+    stacked = parametrization.get_stacked_function(func, symbols)(r)
+    assert stacked.shape == (len(symbols),) + r.shape
+    for symbol, f in zip(symbols, stacked):
+        assert np.allclose(f, parametrization.get_function(func, symbol)(r))
@@ -196,3 +196,39 @@ def test_crystal_potential_with_frozen_phonons(data, potential_unit, tile, num_f
 #
 #     potential1 = potential1.build(lazy=False)
 #     potential2 = potential2.build(lazy=False)
+
+
+def test_integrate_interpolated_slice_matches_map_coordinates():
+    from scipy.ndimage import map_coordinates
+
+    from abtem.potentials.charge_density import _integrate_interpolated_slice
+
+    rng = np.random.default_rng(seed=0)
+    array = rng.random((8, 9, 10))
+    cell = np.array([[4.0, 0.0, 0.0], [0.5, 4.5, 0.0], [0.0, 0.0, 5.0]])
+
+    slice_shape = (6, 7, 5)
+    slice_box = np.diag((3.0, 3.5, 1.2))
+    a = 0.7
+    weights = np.full(slice_shape[-1], slice_box[2, 2] / slice_shape[-1])
+
+    u = np.stack(
+        np.meshgrid(
+            *(np.arange(n) / n for n in slice_shape), indexing="ij"
+        ),
+        axis=-1,
+    )
+    coordinates = np.dot(u, slice_box) + (0.0, 0.0, a)
+    mapped = (np.dot(coordinates, np.linalg.inv(cell)) % 1.0) * array.shape + 3
+
+    padded_array = np.pad(array, ((3, 3),) * 3, mode="wrap")
+    values = map_coordinates(
+        padded_array, mapped.reshape((-1, 3)).T, mode="wrap", order=2
+    ).reshape(slice_shape)
+    expected = (values * weights).sum(-1)
+
+    integrated = _integrate_interpolated_slice(
+        array, cell, slice_shape, slice_box, a, weights
+    )
+
+    assert np.allclose(integrated, expected, atol=1e-7)
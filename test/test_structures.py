@@ -1,9 +1,16 @@
 import numpy as np
 import pytest
 from ase.build import bulk
-from ase import build
+from ase import Atoms, build
 
-from abtem.atoms import orthogonalize_cell, shrink_cell, merge_close_atoms, cut_cell
+from abtem.atoms import (
+    best_orthogonal_cell,
+    cut_cell,
+    merge_close_atoms,
+    orthogonalize_cell,
+    pad_atoms,
+    shrink_cell,
+)
 
 
 def fcc(orthogonal=False):
@@ -101,3 +108,118 @@ def test_cut(structure):
     cut_atoms = cut_cell(atoms, cell=np.diag(orthogonalized_atoms.cell) - 1e-12)
 
     assert_atoms_close(orthogonalized_atoms, cut_atoms)
+
+
+def test_best_orthogonal_cell_returns_copy():
+    cell = np.array(fcc().cell)
+
+    first = best_orthogonal_cell(cell)
+    expected = first.copy()
+    first[:] = 0.0
+
+    second = best_orthogonal_cell(cell)
+    assert second is not first
+    assert np.allclose(second, expected)
+
+
+def hcp_with_atoms_on_faces():
+    atoms = bulk("Be")
+    scaled_positions = [
+        [0.0, 0.0, 0.0],
+        [0.5, 0.0, 0.0],
+        [0.0, 0.5, 0.0],
+        [0.0, 0.0, 0.5],
+        [1 / 3, 2 / 3, 0.25],
+    ]
+    return Atoms(
+        "Be5", scaled_positions=scaled_positions, cell=atoms.cell, pbc=True
+    )
+
+
+def crop_atoms(atoms, margin):
+    scaled_positions = atoms.get_scaled_positions(wrap=False)
+    scaled_margins = np.array(margin) / atoms.cell.lengths()
+    mask = np.all(scaled_positions >= (-scaled_margins - 1e-12)[None], axis=1) * np.all(
+        scaled_positions < (1 + scaled_margins)[None], axis=1
+    )
+    return atoms[mask]
+
+
+def assert_atoms_equal(atoms1, atoms2):
+    assert len(atoms1) == len(atoms2)
+    assert np.all(atoms1.numbers == atoms2.numbers)
+    assert np.allclose(atoms1.positions, atoms2.positions)
+    assert np.allclose(atoms1.cell, atoms2.cell)
+
+
+@pytest.mark.parametrize("margins", [0.5, 2.0, (1.0, 2.5, 0.7)])
+def test_pad_atoms_matches_repeat_and_crop(margins):
+    atoms = hcp_with_atoms_on_faces()
+
+    if not isinstance(margins, tuple):
+        margins = (margins,) * 3
+
+    reps = [
+        int(1 + 2 * np.ceil(margin / atoms.cell[i, i]))
+        for i, margin in enumerate(margins)
+    ]
+    expected = atoms * reps
+    expected.positions[:] -= atoms.cell.sum(axis=0) * [rep // 2 for rep in reps]
+    expected.cell = atoms.cell
+    expected = crop_atoms(expected, margins)
+
+    assert_atoms_equal(pad_atoms(atoms, margins), expected)
+
+
+def repeat_and_cut(atoms, cell, margin):
+    margin = (margin,) * 3
+
+    new_cell = np.diag(np.array(cell) + 2 * np.array(margin))
+    new_cell = np.dot(atoms.cell.scaled_positions(new_cell), atoms.cell)
+
+    scaled_margin = atoms.cell.scaled_positions(np.diag(margin))
+    scaled_margin = np.sign(scaled_margin) * (np.ceil(np.abs(scaled_margin)))
+
+    scaled_corners_new_cell = np.array(
+        [[i, j, k] for i in (0.0, 1.0) for j in (0.0, 1.0) for k in (0.0, 1.0)]
+    )
+    corners = np.dot(scaled_corners_new_cell, new_cell)
+    scaled_corners = np.linalg.solve(atoms.cell.T, corners.T).T
+    repetitions = np.ceil(np.ptp(scaled_corners, axis=0)).astype("int") + 1
+    new_atoms = atoms * repetitions
+
+    center_translate = np.dot(np.floor(scaled_corners.min(axis=0)), atoms.cell)
+    margin_translate = atoms.cell.cartesian_positions(scaled_margin).sum(0)
+    new_atoms.positions[:] += center_translate - margin_translate
+
+    new_atoms.cell = cell
+    return crop_atoms(new_atoms, margin)
+
+
+@pytest.mark.parametrize("margin", [0.0, 0.5, 2.0])
+def test_cut_cell_matches_repeat_and_cut(margin):
+    atoms = hcp_with_atoms_on_faces()
+    cell = tuple(best_orthogonal_cell(atoms.cell))
+
+    expected = repeat_and_cut(atoms, cell, margin)
+
+    assert_atoms_equal(cut_cell(atoms, cell=cell, margin=margin), expected)
+
+
+def test_merge_close_atoms_chain():
+    tol = 0.1
+    atoms = Atoms(
+        "Au3",
+        positions=[
+            [1.0, 1.0, 1.0],
+            [1.0 + 0.6 * tol, 1.0, 1.0],
+            [1.0 + 1.2 * tol, 1.0, 1.0],
+        ],
+        cell=[4.0, 4.0, 4.0],
+        pbc=True,
+    )
+
+    merged = merge_close_atoms(atoms, tol=tol)
+
+    assert len(merged) == 1
+    assert np.allclose(merged.positions, [[1.0 + 0.6 * tol, 1.0, 1.0]])